@@ -1,66 +1,66 @@
 import pandas as pd
 
 
-def transform_traffic_combined_apps(traffic_combined, pre1, pre2, pre3=None):
-    series = traffic_combined.drop('package_name', axis=1).sum().filter(regex='_detected_')
-    numeric_cols = [pre1 + '_non_tracker', pre1 + '_tracker',
-                    pre2 + '_non_tracker', pre2 + '_tracker']
-
-    if pre3:
-        numeric_cols += [pre3 + '_non_tracker', pre3 + '_tracker']
-
-    df_cols = ['data_type'] + numeric_cols
-
-    rows_dict = {}
-
-    for index, value in series.items():
-        # Split the index and determine the base parts (auto/manual and tracker/non_tracker)
-        parts = index.split('_')
-        detection_method = parts[0]  # 'auto' or 'manual'
-        if parts[2] == 'non':  # We have a 'non_tracker' case
-            detection_category = 'non_tracker'
-            data_type_parts = parts[4:]  # Data type starts from the 5th part onwards
-        else:  # We have a 'tracker' case
-            detection_category = 'tracker'
-            data_type_parts = parts[3:]  # Data type starts from the 4th part onwards
-
-        data_type = '_'.join(data_type_parts)
-        column_name = f"{detection_method}_{detection_category}"
+TRACKER_CLASSES = ('non_tracker', 'tracker')
+
+
+def pattern_names(columns, crawls):
+    # pattern names of the <crawl>_detected_<tracker_class>_<name> columns, in order of first appearance
+    prefixes = [f'{crawl}_detected_{tracker_class}_' for crawl in crawls for tracker_class in TRACKER_CLASSES]
+    names = {}
+    for column in columns:
+        for prefix in prefixes:
+            if column.startswith(prefix):
+                names.setdefault(column[len(prefix):], None)
+                break
+    return list(names)
+
+
+def compare_crawls(traffic_combined, crawls, names=None):
+    # Sums of the per-app detection counts for any number of crawls, from a frame with one
+    # <crawl>_detected_<tracker_class>_<name> column per crawl, tracker class and pattern. The columns are looked up
+    # through a (crawl, tracker_class, pattern) MultiIndex and summed in a single reduction that is pivoted to one
+    # row per pattern and one (crawl, tracker_class) column pair per crawl. Missing columns give NaN, which only
+    # turns the (crawl, tracker_class) column they belong to into float.
+    crawls = list(crawls)
+    names = pattern_names(traffic_combined.columns, crawls) if names is None else list(names)
+    index = pd.MultiIndex.from_product([crawls, TRACKER_CLASSES, names], names=['crawl', 'tracker_class', 'pattern'])
+    columns = [f'{crawl}_detected_{tracker_class}_{name}' for crawl, tracker_class, name in index]
+    # present keeps the order of columns (not of the frame), so the sums line up with the index labels
+    available = set(traffic_combined.columns)
+    is_present = [column in available for column in columns]
+    present = [column for column, found in zip(columns, is_present) if found]
+    sums = traffic_combined[present].sum().set_axis(index[is_present])
+    pairs = pd.MultiIndex.from_product([crawls, TRACKER_CLASSES], names=['crawl', 'tracker_class'])
+    patterns = pd.Index(names, name='pattern')
+    # the pivot is assembled per column, each column is reindexed to all patterns on its own
+    parts = {pair: part.droplevel(['crawl', 'tracker_class']) for pair, part in sums.groupby(level=[0, 1], sort=False)}
+    comparison = pd.DataFrame({pair: parts.get(pair, pd.Series(dtype=float)).reindex(patterns) for pair in pairs},
+                              index=patterns)
+    comparison.columns = pairs
+    return comparison
 
-        # Initialize or update the row for the data_type
-        if data_type not in rows_dict:
-            rows_dict[data_type] = {col: pd.NA for col in df_cols}
-            rows_dict[data_type]['data_type'] = data_type
-        rows_dict[data_type][column_name] = value
 
-    # Create DataFrame from rows_dict
-    df = pd.DataFrame(list(rows_dict.values()), columns=df_cols)
-
-    # Convert numeric columns to appropriate type
+def transform_traffic_combined_apps(traffic_combined, pre1, pre2, pre3=None):
+    # compare_crawls flattened to one data_type row with <crawl>_<tracker_class> columns per pattern
+    comparison = compare_crawls(traffic_combined, [pre for pre in (pre1, pre2, pre3) if pre])
+    comparison.columns = [f'{crawl}_{tracker_class}' for crawl, tracker_class in comparison.columns]
+    return comparison.rename_axis('data_type').reset_index()
 
-    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors='coerce')
 
-    return df
+def aggregate_comparison(comparison, r_combined, mapping_target: str):
+    # sums the pattern rows of a compare_crawls result per value of a pattern attribute (e.g. category)
+    pattern_to_target = {d['name']: d[mapping_target] for d in r_combined}
+    return comparison.groupby(comparison.index.map(pattern_to_target).rename(mapping_target)).sum()
 
 
 def aggregate_data_types(data_types_combined, r_combined, mapping_target: str):
-    data_types_combined = data_types_combined.copy()
     # Strip the mapping_target string to remove leading/trailing whitespaces or hidden characters
     mapping_target_clean = mapping_target.strip()
 
-    # Create data_type to target mapping
-    data_type_to_target = {d['name']: d[mapping_target_clean] for d in r_combined}
-
-    # Map data_type to target in the DataFrame
-    data_types_combined[mapping_target_clean] = data_types_combined['data_type'].map(data_type_to_target)
-
-    # Aggregate by target
-    aggregated_by_target = data_types_combined.groupby(mapping_target_clean).sum()
-
-    # Drop the data_type column from aggregation, if present
-    aggregated_by_target.drop(columns=['data_type'], errors='ignore', inplace=True)
+    # the data types become the pattern index of the comparison, so the mapping is applied to the index
+    comparison = data_types_combined.set_index('data_type')
+    aggregated_by_target = aggregate_comparison(comparison, r_combined, mapping_target_clean)
 
     # Reset the index to make the mapping_target a column
-    aggregated_by_target = aggregated_by_target.reset_index()
-
-    return aggregated_by_target
+    return aggregated_by_target.reset_index()
@@ -0,0 +1,289 @@
+import hashlib
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import time
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+# bump this whenever the derived tables change shape, so stale cache entries are never picked up
+CACHE_VERSION = 1
+BYTES_SUFFIX = '__bytes'
+
+
+def fingerprint_file(path: str, hash_content: bool = False):
+    stat = os.stat(path)
+    fingerprint = {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    if hash_content:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        fingerprint['sha256'] = digest.hexdigest()
+    return fingerprint
+
+
+def _split_bytes_columns(df: pd.DataFrame):
+    # Arrow cannot store object columns that mix str and bytes (binary request bodies), so those columns are
+    # split into a string column and a binary side column that are merged again on load
+    split_columns = []
+    for column in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[column], skipna=True) not in ('mixed', 'bytes'):
+            continue
+        is_bytes = df[column].map(lambda x: isinstance(x, bytes)).to_numpy(dtype=bool)
+        if not is_bytes.any():
+            continue
+        if not split_columns:
+            df = df.copy()
+        df[column + BYTES_SUFFIX] = df[column].where(is_bytes, None)
+        df[column] = df[column].where(~is_bytes, None)
+        split_columns.append(column)
+    return df, split_columns
+
+
+def _merge_bytes_columns(df: pd.DataFrame, split_columns):
+    for column in split_columns:
+        binary = df.pop(column + BYTES_SUFFIX)
+        df[column] = df[column].astype(object).where(binary.isna(), binary.astype(object))
+    return df
+
+
+class DataCache:
+    # On-disk cache of derived DataFrames in the Arrow IPC (feather) format. Each entry is a directory named after
+    # a key that is derived from the fingerprints of all source files, so any change to a source invalidates it.
+    # Entries are evicted least recently used first once the cache grows beyond max_bytes.
+    def __init__(self, cache_dir: str, max_bytes: int = 8 * 1024 ** 3, hash_content: bool = False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, source_paths: dict, **params) -> str:
+        sources = {name: fingerprint_file(path, self.hash_content) for name, path in sorted(source_paths.items())}
+        payload = json.dumps({'version': CACHE_VERSION, 'sources': sources, 'params': params}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+    def __entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def __table_path(self, key: str, table: str) -> str:
+        return os.path.join(self.__entry_dir(key), f'{table}.arrow')
+
+    def __read_meta(self, key: str):
+        path = os.path.join(self.__entry_dir(key), 'meta.json')
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as file:
+            return json.load(file)
+
+    def __write_meta(self, key: str, meta):
+        with open(os.path.join(self.__entry_dir(key), 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+    def has(self, key: str, table: str) -> bool:
+        return os.path.exists(self.__table_path(key, table))
+
+    def load(self, key: str, table: str):
+        path = self.__table_path(key, table)
+        if not os.path.exists(path):
+            return None
+        # tables are written uncompressed, so they can be memory-mapped instead of read into a buffer first
+        df = feather.read_table(path, memory_map=True).to_pandas()
+        df = _merge_bytes_columns(df, self.__read_meta(key).get(table, {}).get('bytes_columns', []))
+        # touching the entry directory marks it as recently used for the eviction below
+        os.utime(self.__entry_dir(key))
+        return df
+
+    def store(self, key: str, table: str, df: pd.DataFrame):
+        os.makedirs(self.__entry_dir(key), exist_ok=True)
+        df, split_columns = _split_bytes_columns(df)
+        path = self.__table_path(key, table)
+        tmp_path = path + '.tmp'
+        feather.write_feather(pa.Table.from_pandas(df), tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+
+        meta = self.__read_meta(key)
+        meta[table] = {'bytes_columns': split_columns, 'rows': len(df)}
+        self.__write_meta(key, meta)
+        os.utime(self.__entry_dir(key))
+        self.__enforce_size_cap(keep=key)
+
+    def remove(self, key: str, table: str):
+        # drop a single table of an entry
+        path = self.__table_path(key, table)
+        if os.path.exists(path):
+            os.remove(path)
+        meta = self.__read_meta(key)
+        if table in meta:
+            del meta[table]
+            self.__write_meta(key, meta)
+
+    def tables(self, key: str):
+        # names of the tables stored under key, in the order they were first stored
+        return [table for table in self.__read_meta(key) if self.has(key, table)]
+
+    def invalidate(self, key: str = None):
+        # drop a single entry, or everything in the cache directory if no key is given
+        keys = [key] if key is not None else self.keys()
+        for k in keys:
+            shutil.rmtree(self.__entry_dir(k), ignore_errors=True)
+
+    def keys(self):
+        return [name for name in os.listdir(self.cache_dir) if os.path.isdir(self.__entry_dir(name))]
+
+    def entry_size(self, key: str) -> int:
+        entry_dir = self.__entry_dir(key)
+        return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+    def size(self) -> int:
+        return sum(self.entry_size(key) for key in self.keys())
+
+    def __enforce_size_cap(self, keep: str = None):
+        entries = sorted(self.keys(), key=lambda k: os.path.getmtime(self.__entry_dir(k)))
+        total = sum(self.entry_size(key) for key in entries)
+        for key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.entry_size(key)
+            self.invalidate(key)
+
+
+def content_digest(body) -> bytes:
+    # str and bytes bodies with the same bytes must not collide, hence the type prefix
+    if isinstance(body, bytes):
+        data = b'b' + body
+    else:
+        data = b's' + str(body).encode('utf-8', 'surrogatepass')
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class ContentMemo:
+    # Content-addressed memo of per-body results. map() hashes every distinct body, looks its result up under a
+    # namespace (which identifies the function and its configuration), computes only the misses and broadcasts the
+    # results back to all rows sharing a body. Without a path the memo lives in memory for the session, with a path
+    # it persists in a SQLite file between runs. Least recently used entries of a namespace are evicted beyond
+    # max_entries in that namespace, so cheap per-body results (cleaning, regexes) never evict expensive ones
+    # (AI detections) stored in the same memo.
+    def __init__(self, path: str = None, max_entries: int = 1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        self.rows = 0
+        self.hits = 0
+        self.misses = 0
+        # namespace -> OrderedDict of digest -> result, least recently used first
+        self.__memory = {}
+        self.__conn = None
+        if path is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.__conn = sqlite3.connect(path)
+            self.__conn.execute('CREATE TABLE IF NOT EXISTS memo (namespace TEXT, digest BLOB, value BLOB, '
+                                'last_used REAL, PRIMARY KEY (namespace, digest))')
+            # memo files of earlier versions evicted by last_used across all namespaces
+            self.__conn.execute('DROP INDEX IF EXISTS memo_last_used')
+            self.__conn.execute('CREATE INDEX IF NOT EXISTS memo_namespace_last_used ON memo (namespace, last_used)')
+
+    def lookup(self, namespace: str, digests):
+        # the stored results of those digests that are in the memo, as {digest: result}
+        found = {}
+        if self.__conn is None:
+            entries = self.__memory.get(namespace, {})
+            for digest in digests:
+                if digest in entries:
+                    entries.move_to_end(digest)
+                    found[digest] = entries[digest]
+            return found
+        now = time.time()
+        for start in range(0, len(digests), 500):
+            batch = digests[start:start + 500]
+            rows = self.__conn.execute('SELECT digest, value FROM memo WHERE namespace = ? AND digest IN ({})'
+                                       .format(', '.join('?' * len(batch))), [namespace] + batch).fetchall()
+            found.update((digest, pickle.loads(value)) for digest, value in rows)
+            self.__conn.executemany('UPDATE memo SET last_used = ? WHERE namespace = ? AND digest = ?',
+                                    [(now, namespace, digest) for digest, _ in rows])
+        # commit the last_used updates right away, an open write transaction would lock out other connections
+        self.__conn.commit()
+        return found
+
+    def store(self, namespace: str, results: dict):
+        # results as {digest: result}, for results that are computed outside of map (e.g. by a batch job)
+        if self.__conn is None:
+            entries = self.__memory.setdefault(namespace, OrderedDict())
+            for digest, value in results.items():
+                entries[digest] = value
+                entries.move_to_end(digest)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            return
+        now = time.time()
+        self.__conn.executemany('INSERT OR REPLACE INTO memo VALUES (?, ?, ?, ?)',
+                                [(namespace, digest, pickle.dumps(value), now) for digest, value in results.items()])
+        excess = self.__conn.execute('SELECT COUNT(*) FROM memo WHERE namespace = ?',
+                                     (namespace,)).fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.__conn.execute('DELETE FROM memo WHERE rowid IN (SELECT rowid FROM memo WHERE namespace = ? '
+                                'ORDER BY last_used LIMIT ?)', (namespace, excess))
+        self.__conn.commit()
+
+    def map(self, values, func, namespace: str, cacheable=None):
+        # returns an object array with func(value) for every value, missing values map to None. With cacheable, a
+        # computed result is only stored if cacheable(value) is true afterwards (e.g. not for incomplete results)
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        uniques = list(uniques)
+        digests = [content_digest(value) for value in uniques]
+        found = self.lookup(namespace, digests)
+        missing = {digest: value for digest, value in zip(digests, uniques) if digest not in found}
+        computed = {digest: func(value) for digest, value in missing.items()}
+        stored = computed
+        if cacheable is not None:
+            stored = {digest: result for digest, result in computed.items() if cacheable(missing[digest])}
+        if stored:
+            self.store(namespace, stored)
+        found.update(computed)
+
+        self.rows += len(codes)
+        self.hits += len(uniques) - len(computed)
+        self.misses += len(computed)
+        results = np.empty(len(uniques) + 1, dtype=object)
+        for i, digest in enumerate(digests):
+            results[i] = found[digest]
+        return results[codes]
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        # hit_rate counts distinct bodies found in the memo, dedup_rate the rows that did not need their own call
+        return {
+            'rows': self.rows,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'dedup_rate': 1 - self.misses / self.rows if self.rows else 0.0,
+        }
+
+    def clear(self, namespace: str = None):
+        if self.__conn is None:
+            if namespace is None:
+                self.__memory.clear()
+            else:
+                self.__memory.pop(namespace, None)
+            return
+        if namespace is None:
+            self.__conn.execute('DELETE FROM memo')
+        else:
+            self.__conn.execute('DELETE FROM memo WHERE namespace = ?', (namespace,))
+        self.__conn.commit()
+
+    def close(self):
+        if self.__conn is not None:
+            self.__conn.close()
+            self.__conn = None
@@ -1,5 +1,26 @@
 import base64
+import codecs
+import gzip
+import re
+import time
 import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+BASE64_MP_PREFIXES = ('data=W', 'data=e')
+BASE64_CLUE_PREFIXES = ('{"schema":"iglu:com', '{"p":"ey')
+PAYLOAD_TEXT = 'text'
+PAYLOAD_BINARY = 'binary'
+PAYLOAD_MIXED = 'mixed'
+# ASCII control characters except tab, line feed and carriage return
+CONTROL_BYTES = bytes(b for b in range(32) if b not in (9, 10, 13)) + b'\x7f'
+REPLACEMENT_CHAR_UTF8 = '\ufffd'.encode('utf-8')
+# bump the version whenever the cleaners change, so memoized results of older cleaners are not reused
+CLEAN_MEMO_NAMESPACE = 'clean_traffic:v1'
 
 
 def __replace_base64_mp(content):
@@ -56,18 +77,69 @@ def __replace_base64_clue(content):
         return content
 
 
+class PayloadInfo(NamedTuple):
+    kind: str
+    # number of bytes, or of characters for str payloads
+    length: int
+    # True or False if the whole payload was checked, None if only the scanned sample is known to be valid UTF-8
+    utf8_valid: Optional[bool]
+
+
+def _count_invalid_utf8(data: bytes, final: bool = True) -> int:
+    # decoding with the replace handler never raises, invalid sequences show up as U+FFFD
+    text = codecs.getincrementaldecoder('utf-8')('replace').decode(data, final=final)
+    return text.count('\ufffd') - data.count(REPLACEMENT_CHAR_UTF8)
+
+
+def classify_payload(payload, sample_size: int = 4096, control_ratio: float = 0.1,
+                     invalid_ratio: float = 0.05) -> PayloadInfo:
+    # Classifies a body as text, binary or mixed from a bounded sample of its first bytes, without raising:
+    # text is valid UTF-8 with few control characters, binary has many control characters or invalid sequences,
+    # and mixed is mostly text with some invalid sequences. Missing bodies (None, NaN) and anything else that is
+    # neither str nor bytes-like count as empty text.
+    if isinstance(payload, str):
+        return PayloadInfo(PAYLOAD_TEXT, len(payload), True)
+    if not isinstance(payload, (bytes, bytearray, memoryview)):
+        return PayloadInfo(PAYLOAD_TEXT, 0, True)
+    view = memoryview(payload).cast('B')
+    complete = view.nbytes <= sample_size
+    sample = view[:sample_size].tobytes()
+    if len(sample) == 0:
+        return PayloadInfo(PAYLOAD_TEXT, 0, True)
+
+    # a multi-byte character cut at the end of the sample is not counted as invalid
+    invalid = _count_invalid_utf8(sample, final=complete)
+    controls = len(sample) - len(sample.translate(None, CONTROL_BYTES))
+    if invalid == 0 and controls <= control_ratio * len(sample):
+        kind = PAYLOAD_TEXT
+    elif controls > control_ratio * len(sample) or invalid > invalid_ratio * len(sample):
+        kind = PAYLOAD_BINARY
+    else:
+        kind = PAYLOAD_MIXED
+    utf8_valid = False if invalid else (True if complete else None)
+    return PayloadInfo(kind, view.nbytes, utf8_valid)
+
+
+def classify_payloads(traffic, column: str = 'request_content', sample_size: int = 4096):
+    # payload_kind and payload_length per row, so later stages can skip binary bodies without reading them again
+    infos = [classify_payload(value, sample_size) for value in traffic[column].to_numpy(dtype=object)]
+    return pd.DataFrame({
+        'payload_kind': pd.Categorical([info.kind for info in infos],
+                                       categories=[PAYLOAD_TEXT, PAYLOAD_MIXED, PAYLOAD_BINARY]),
+        'payload_length': np.array([info.length for info in infos], dtype='int64'),
+    }, index=traffic.index)
+
+
 def __replace_binary_data(cell):
-    try:
-        # Try decoding as utf-8
-        cell.decode('utf-8')
-        # If successful, return the cell as is
-        return cell
-    except AttributeError:
-        # This exception is raised if the object is already a str, indicating it's not binary
+    # str (and anything else without a decode method) is never binary
+    if not isinstance(cell, (bytes, bytearray)):
         return cell
-    except Exception:
-        # If any other exception is raised, replace the content with "BINARY_DATA"
-        return "BINARY_DATA"
+    utf8_valid = classify_payload(cell).utf8_valid
+    if utf8_valid is None:
+        # the sample was valid, check the rest of the payload as well
+        utf8_valid = _count_invalid_utf8(bytes(cell)) == 0
+    # valid UTF-8 is returned as is, anything else is replaced with a placeholder
+    return cell if utf8_valid else "BINARY_DATA"
 
 
 def __clean_base64(traffic):
@@ -100,10 +172,294 @@ def __clean_response(traffic):
         if row['response_content_length'] > 0 else row['response_content'], axis=1)
 
 
-def clean_traffic(traffic):
+def __nonempty_mask(traffic):
+    # the rows the row-wise cleaners touch: request_content is not None and request_content_length > 0
+    return (traffic['request_content'].notna() & (traffic['request_content_length'] > 0)).to_numpy()
+
+
+def __map_unique(values, func):
+    # applies func once per distinct value and broadcasts the results back
+    codes, uniques = pd.factorize(values)
+    return np.array([func(value) for value in uniques] + [None], dtype=object)[codes]
+
+
+def __clean_request_vectorized(traffic):
+    content = traffic['request_content'].to_numpy(dtype=object, copy=True)
+    nonempty = __nonempty_mask(traffic)
+    series = pd.Series(content, dtype=object)
+
+    is_str = nonempty.copy()
+    if pd.api.types.infer_dtype(series[nonempty], skipna=True) != 'string':
+        is_str &= series.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+        # anything that is not a str (e.g. bytes) runs through the row-wise cleaners, so it behaves exactly as before
+        for i in np.flatnonzero(nonempty & ~is_str):
+            value = __replace_base64_clue(__replace_base64_mp(content[i]))
+            value = __replace_binary_data(value)
+            content[i] = urllib.parse.unquote(value)
+
+    # the base64 prefixes are disjoint, so both masks can be taken from the raw content; binary detection is a no-op
+    # for str values
+    text = series.where(is_str, '')
+    mp_mask = is_str & text.str.startswith(BASE64_MP_PREFIXES).to_numpy(dtype=bool)
+    clue_mask = is_str & text.str.startswith(BASE64_CLUE_PREFIXES).to_numpy(dtype=bool)
+    content[mp_mask] = [__replace_base64_mp(value) for value in content[mp_mask]]
+    content[clue_mask] = [__replace_base64_clue(value) for value in content[clue_mask]]
+
+    # unquote returns strings without a percent sign unchanged
+    if is_str.any():
+        quoted = is_str.copy()
+        quoted[is_str] = pd.Series(content[is_str], dtype=object).str.contains('%', regex=False).to_numpy(dtype=bool)
+        if quoted.any():
+            content[quoted] = __map_unique(content[quoted], urllib.parse.unquote)
+
+    traffic['request_content'] = pd.Series(content, index=traffic.index)
+
+
+def __clean_response_vectorized(traffic):
+    response = traffic['response_content'].to_numpy(dtype=object, copy=True)
+    response[(traffic['response_content_length'] > 0).to_numpy()] = None
+    traffic['response_content'] = pd.Series(response, index=traffic.index)
+
+
+def __clean_request_chunk(chunk, engine):
+    # runs in a pool worker on a frame with only request_content and request_content_length
+    if engine == 'rowwise':
+        __clean_base64(chunk)
+        __clean_binary(chunk)
+        __clean_urlencoded(chunk)
+    else:
+        __clean_request_vectorized(chunk)
+    return chunk['request_content'].to_numpy(dtype=object)
+
+
+def __clean_request_parallel(traffic, engine, workers, chunksize):
+    # only the columns the request cleaners read are pickled to the workers, in a few large chunks per worker
+    columns = traffic[['request_content', 'request_content_length']]
+    if chunksize is None:
+        chunksize = max(1, -(-len(columns) // (workers * 4)))
+    chunks = [columns.iloc[start:start + chunksize] for start in range(0, len(columns), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map yields the results in the order of the chunks
+        results = list(executor.map(partial(__clean_request_chunk, engine=engine), chunks))
+    content = np.concatenate(results) if results else np.array([], dtype=object)
+    traffic['request_content'] = pd.Series(content, index=traffic.index)
+
+
+def __clean_request_value(content):
+    # the row-wise cleaners applied to a single non-empty body
+    content = __replace_base64_clue(__replace_base64_mp(content))
+    return urllib.parse.unquote(__replace_binary_data(content))
+
+
+def __clean_request_memo(traffic, memo):
+    content = traffic['request_content'].to_numpy(dtype=object, copy=True)
+    nonempty = __nonempty_mask(traffic)
+    if nonempty.any():
+        content[nonempty] = memo.map(content[nonempty], __clean_request_value, CLEAN_MEMO_NAMESPACE)
+    traffic['request_content'] = pd.Series(content, index=traffic.index)
+
+
+def clean_traffic(traffic, engine: str = 'vectorized', workers: int = None, chunksize: int = None, memo=None):
+    # engine 'vectorized' selects the rows that need work with Series-level tests and produces exactly the output of
+    # the original row-wise engine ('rowwise'). With workers > 1 the request bodies are cleaned in chunks of
+    # chunksize rows on a process pool. With a memo (cache_data.ContentMemo) every distinct body is cleaned only
+    # once, in this process, and the results are reused across runs; the engine and workers are then ignored.
+    if engine not in ('rowwise', 'vectorized'):
+        raise ValueError(f"Unknown cleaning engine: {engine}")
+    traffic_copy = traffic.copy()
+    if memo is not None:
+        __clean_response_vectorized(traffic_copy)
+        __clean_request_memo(traffic_copy, memo)
+    elif workers is not None and workers > 1:
+        __clean_response_vectorized(traffic_copy)
+        __clean_request_parallel(traffic_copy, engine, workers, chunksize)
+    elif engine == 'rowwise':
+        __clean_response(traffic_copy)
+        __clean_base64(traffic_copy)
+        __clean_binary(traffic_copy)
+        __clean_urlencoded(traffic_copy)
+    else:
+        __clean_response_vectorized(traffic_copy)
+        __clean_request_vectorized(traffic_copy)
+    return traffic_copy
+
+
+# Decoder pipeline: a registry of decoders that is applied to every body once, unwrapping nested encodings
+# (e.g. base64 inside URL encoding inside gzip) layer by layer up to a depth limit.
+
+JWT_PATTERN = re.compile(r'eyJ[A-Za-z0-9_-]+\.eyJ[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]*)?')
+PERCENT_PATTERN = re.compile(r'%[0-9A-Fa-f]{2}')
+# a base64 value that is the whole body, the value of a key=value field or a JSON string
+BASE64_VALUE_PATTERN = re.compile(r'(?<![^=":])[A-Za-z0-9+/_-]{16,}={0,2}(?![^&",;}\]\s])')
+
+
+class Decoder:
+    # sniff is a cheap test whether a body may carry this encoding, decode returns the decoded body
+    # or None if the body turned out not to be encoded this way
+    def __init__(self, name: str, sniff, decode):
+        self.name = name
+        self.sniff = sniff
+        self.decode = decode
+
+
+def _b64decode_text(block: str):
+    # decodes (url-safe) base64 with or without padding to text, None if the result is not valid UTF-8
+    try:
+        raw = base64.b64decode(block + '=' * (-len(block) % 4), '-_' if ('-' in block or '_' in block) else None)
+        return raw.decode('utf-8')
+    except ValueError:
+        return None
+
+
+def _sniff_gzip(body):
+    return body[:2] == b'\x1f\x8b' if isinstance(body, bytes) else body.startswith('H4sI')
+
+
+def _decode_gzip(body):
+    try:
+        raw = body if isinstance(body, bytes) else base64.b64decode(body)
+        raw = gzip.decompress(raw)
+    except (ValueError, OSError, EOFError):
+        return None
+    try:
+        return raw.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw
+
+
+def _sniff_bytes(body):
+    return isinstance(body, bytes)
+
+
+def _decode_bytes(body):
+    info = classify_payload(body)
+    if info.kind == PAYLOAD_BINARY or info.utf8_valid is False:
+        return 'BINARY_DATA'
+    return body.decode('utf-8', 'replace')
+
+
+def _sniff_base64_mp(body):
+    return isinstance(body, str) and body.startswith(BASE64_MP_PREFIXES)
+
+
+def _decode_base64_mp(body):
+    return __replace_base64_mp(body)
+
+
+def _sniff_base64_clue(body):
+    return isinstance(body, str) and body.startswith(BASE64_CLUE_PREFIXES)
+
+
+def _decode_base64_clue(body):
+    return __replace_base64_clue(body)
+
+
+def _sniff_jwt(body):
+    return isinstance(body, str) and 'eyJ' in body and '.' in body
+
+
+def _decode_jwt(body):
+    # replaces header.payload[.signature] by the decoded header and payload JSON, undecodable tokens are kept
+    def replace(match):
+        segments = match.group(0).split('.')
+        decoded = [_b64decode_text(segment) for segment in segments[:2]]
+        if None in decoded:
+            return match.group(0)
+        return '.'.join(decoded)
+    return JWT_PATTERN.sub(replace, body)
+
+
+def _sniff_urlencoded(body):
+    return isinstance(body, str) and '%' in body and PERCENT_PATTERN.search(body) is not None
+
+
+def _decode_urlencoded(body):
+    return urllib.parse.unquote(body)
+
+
+def _sniff_base64(body):
+    return isinstance(body, str) and BASE64_VALUE_PATTERN.search(body) is not None
+
+
+def _decode_base64(body):
+    # decodes the body or its base64 field values in place, like _decode_jwt does for tokens
+    def replace(match):
+        text = _b64decode_text(match.group(0))
+        # only accept printable results, random tokens also happen to be valid base64
+        if text is None or not text.isprintable():
+            return match.group(0)
+        return text
+    return BASE64_VALUE_PATTERN.sub(replace, body)
+
+
+def default_decoders():
+    return [
+        Decoder('gzip', _sniff_gzip, _decode_gzip),
+        Decoder('bytes', _sniff_bytes, _decode_bytes),
+        Decoder('base64_mp', _sniff_base64_mp, _decode_base64_mp),
+        Decoder('base64_clue', _sniff_base64_clue, _decode_base64_clue),
+        Decoder('jwt', _sniff_jwt, _decode_jwt),
+        Decoder('urlencoded', _sniff_urlencoded, _decode_urlencoded),
+        Decoder('base64', _sniff_base64, _decode_base64),
+    ]
+
+
+class DecoderPipeline:
+    # Every body is visited once: the decoders are tried in registry order and after each decoder that changed the
+    # body the registry is walked again from the start, until no decoder fires or max_depth layers were unwrapped.
+    def __init__(self, decoders=None, max_depth: int = 4):
+        self.decoders = []
+        self.max_depth = max_depth
+        self.stats = {}
+        for decoder in (decoders if decoders is not None else default_decoders()):
+            self.register(decoder)
+
+    def register(self, decoder: Decoder, before: str = None):
+        if any(registered.name == decoder.name for registered in self.decoders):
+            raise ValueError(f"Decoder already registered: {decoder.name}")
+        names = [registered.name for registered in self.decoders]
+        position = names.index(before) if before is not None else len(self.decoders)
+        self.decoders.insert(position, decoder)
+        self.stats[decoder.name] = {'sniffed': 0, 'fired': 0, 'seconds': 0.0}
+
+    def decode(self, body):
+        # returns the decoded body and the names of the decoders that fired, in order
+        fired = []
+        for _ in range(self.max_depth):
+            for decoder in self.decoders:
+                if not decoder.sniff(body):
+                    continue
+                stats = self.stats[decoder.name]
+                stats['sniffed'] += 1
+                start = time.perf_counter()
+                decoded = decoder.decode(body)
+                stats['seconds'] += time.perf_counter() - start
+                if decoded is not None and decoded != body:
+                    stats['fired'] += 1
+                    fired.append(decoder.name)
+                    body = decoded
+                    break
+            else:
+                break
+        return body, tuple(fired)
+
+    def timings(self):
+        timings = pd.DataFrame.from_dict(self.stats, orient='index')
+        timings.index.name = 'decoder'
+        return timings
+
+
+def decode_traffic(traffic, pipeline: DecoderPipeline = None):
+    # Returns a copy of traffic whose non-empty request bodies went through the decoder pipeline, with a decoders
+    # column listing the decoders that fired per row (comma separated, in order). The pipeline keeps the per-decoder
+    # counters and timings.
+    pipeline = pipeline if pipeline is not None else DecoderPipeline()
     traffic_copy = traffic.copy()
-    __clean_response(traffic_copy)
-    __clean_base64(traffic_copy)
-    __clean_binary(traffic_copy)
-    __clean_urlencoded(traffic_copy)
+    content = traffic_copy['request_content'].to_numpy(dtype=object, copy=True)
+    fired = np.full(len(content), '', dtype=object)
+    for i in np.flatnonzero(__nonempty_mask(traffic_copy)):
+        content[i], decoders = pipeline.decode(content[i])
+        fired[i] = ','.join(decoders)
+    traffic_copy['request_content'] = pd.Series(content, index=traffic_copy.index)
+    traffic_copy['decoders'] = pd.Series(fired, index=traffic_copy.index)
     return traffic_copy
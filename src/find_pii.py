@@ -1,108 +1,409 @@
+import hashlib
 import ipaddress
-
+import json
+import re
+import sys
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
 import pandas as pd
 
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 
 def search_pattern(row, pattern):
     return bool(pattern['regex'].search(row['request_content']))
 
 
-def apply_regexes(traffic, regexes):
-    traffic_copy = traffic.copy()
-    for pattern in regexes:
-        column_name = f"detected_{pattern['name']}"
-        traffic_copy[column_name] = traffic_copy.apply(search_pattern, axis=1, pattern=pattern)
+def regexes_fingerprint(regexes):
+    # identifies a pattern set by its names, regex sources and flags
+    payload = json.dumps([[p['name'], p['regex'].pattern, p['regex'].flags] for p in regexes])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def __search_all(content, regexes):
+    return tuple(bool(pattern['regex'].search(content)) for pattern in regexes)
+
+
+# repeats whose body has to occur at least once when the minimum count is non-zero
+REPEAT_OPS = {sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT, getattr(sre_parse, 'POSSESSIVE_REPEAT', sre_parse.MAX_REPEAT)}
+# atomic groups only exist from Python 3.11 on
+ATOMIC_GROUP = getattr(sre_parse, 'ATOMIC_GROUP', None)
+
+
+def __best_requirement(requirements):
+    # the most selective of several requirements that all have to hold: longest shortest literal, then fewest literals
+    requirements = [r for r in requirements if r]
+    if not requirements:
+        return None
+    return max(requirements, key=lambda r: (min(len(literal) for literal in r), -len(r)))
+
+
+def __required_literals(items):
+    # A set of literals of which at least one occurs in every match of the parsed sequence, or None if none can be
+    # derived. Runs of plain literals in a sequence are all mandatory, alternations need a literal from every branch.
+    requirements = []
+    run = []
+    for op, value in list(items) + [(None, None)]:
+        if op == sre_parse.LITERAL:
+            run.append(chr(value))
+            continue
+        if run:
+            requirements.append({''.join(run)})
+            run = []
+        if op == sre_parse.SUBPATTERN:
+            requirements.append(__required_literals(value[-1]))
+        elif op is not None and op == ATOMIC_GROUP:
+            requirements.append(__required_literals(value))
+        elif op == sre_parse.ASSERT:
+            # a positive lookaround only matches if its text is present in the body
+            requirements.append(__required_literals(value[1]))
+        elif op in REPEAT_OPS and value[0] >= 1:
+            requirements.append(__required_literals(value[2]))
+        elif op == sre_parse.BRANCH:
+            branches = [__required_literals(branch) for branch in value[1]]
+            if all(branches):
+                requirements.append(set().union(*branches))
+    return __best_requirement(requirements)
+
+
+# character to folded character, built on first use by case_fold
+_FOLD_TABLE = {}
+
+
+def __fold_table():
+    # Folds every character at least as far as re does under IGNORECASE: re compares the simple lowercase of two
+    # characters and additionally treats characters with the same uppercase as equal (i and dotless ı, s and long ſ,
+    # the Kelvin sign and k), so the lowercase of the uppercase of the lowercase merges every pair re matches.
+    # str.casefold cannot be used, it expands İ to i plus a combining dot and leaves ı alone.
+    if not _FOLD_TABLE:
+        for code in range(sys.maxunicode + 1):
+            character = chr(code)
+            if character.lower() == character and character.upper() == character:
+                continue
+            # İ is the only character whose full lowercase has more than one character, its simple lowercase is i
+            lower = character.lower()[0]
+            upper = lower.upper()
+            folded = upper.lower() if len(upper) == 1 and len(upper.lower()) == 1 else lower
+            if folded != character:
+                _FOLD_TABLE[code] = folded
+    return _FOLD_TABLE
+
+
+def case_fold(text: str) -> str:
+    # a case-insensitive match of re can only occur where the folded text contains the folded literal
+    if text.isascii():
+        return text.lower()
+    return text.translate(__fold_table())
+
+
+def required_literals(regex):
+    # case folded literals of which at least one has to occur (case-insensitively) in any body the regex matches
+    if not isinstance(regex.pattern, str):
+        return None
+    literals = __required_literals(sre_parse.parse(regex.pattern, regex.flags))
+    return tuple(sorted({case_fold(literal) for literal in literals})) if literals else None
+
+
+class LiteralPrefilter:
+    # Runs a pattern only on bodies that contain one of its mandatory literals. The literals are extracted from the
+    # compiled regex or declared as a list under a 'literals' key next to 'regex', and matched case-insensitively
+    # against the case folded body (see case_fold) in one pass of an Aho-Corasick automaton. A literal hit only makes a pattern
+    # possible, its regex still decides, so the hits are identical to searching every pattern. Patterns without
+    # literals are always searched. Can be passed as matcher to apply_regexes.
+    def __init__(self, regexes):
+        self.regexes = regexes
+        self.literals = []
+        self.always_indices = []
+        self.__literal_to_indices = {}
+        for i, pattern in enumerate(regexes):
+            if pattern.get('literals'):
+                literals = tuple(sorted({case_fold(literal) for literal in pattern['literals']}))
+            else:
+                literals = required_literals(pattern['regex'])
+            self.literals.append(literals)
+            if literals is None:
+                self.always_indices.append(i)
+                continue
+            for literal in literals:
+                self.__literal_to_indices.setdefault(literal, []).append(i)
+
+        # imported here, so the default row-wise path does not need the C extension
+        import ahocorasick
+
+        self.automaton = ahocorasick.Automaton()
+        for literal, indices in self.__literal_to_indices.items():
+            self.automaton.add_word(literal, tuple(indices))
+        if self.__literal_to_indices:
+            self.automaton.make_automaton()
+        self.bodies = 0
+        self.evaluations = 0
+        self.skipped = 0
+
+    def candidates(self, content):
+        # indices of the patterns that can match content
+        if not isinstance(content, str) or not self.__literal_to_indices:
+            return range(len(self.regexes))
+        possible = set(self.always_indices)
+        for _, indices in self.automaton.iter(case_fold(content)):
+            possible.update(indices)
+        return sorted(possible)
+
+    def match(self, content):
+        hits = [False] * len(self.regexes)
+        candidates = self.candidates(content)
+        for i in candidates:
+            hits[i] = bool(self.regexes[i]['regex'].search(content))
+        self.bodies += 1
+        self.evaluations += len(candidates)
+        self.skipped += len(self.regexes) - len(candidates)
+        return tuple(hits)
+
+    @property
+    def skip_rate(self) -> float:
+        total = self.evaluations + self.skipped
+        return self.skipped / total if total else 0.0
+
+    def stats(self):
+        return {
+            'bodies': self.bodies,
+            'evaluations': self.evaluations,
+            'skipped': self.skipped,
+            'skip_rate': self.skip_rate,
+            'patterns_without_literals': [self.regexes[i]['name'] for i in self.always_indices],
+        }
+
+
+# re flags and the regex module flags with the same meaning, the constants differ (re.ASCII is regex.V1)
+REGEX_MODULE_FLAGS = (('IGNORECASE', 'IGNORECASE'), ('MULTILINE', 'MULTILINE'), ('DOTALL', 'DOTALL'),
+                      ('VERBOSE', 'VERBOSE'), ('ASCII', 'ASCII'), ('UNICODE', 'UNICODE'), ('LOCALE', 'LOCALE'))
+
+
+def _interruptible(compiled):
+    # the pattern compiled with the regex module, whose searches accept a timeout, in its re-compatible V0 mode
+    # imported here, so only a time budget needs the regex module
+    import regex
+
+    flags = regex.V0
+    remaining = compiled.flags
+    for re_name, regex_name in REGEX_MODULE_FLAGS:
+        if compiled.flags & getattr(re, re_name):
+            flags |= getattr(regex, regex_name)
+            remaining &= ~getattr(re, re_name)
+    if remaining:
+        raise ValueError(f"Cannot translate the flags {remaining} of pattern {compiled.pattern!r} to the regex module")
+    return regex.compile(compiled.pattern, flags)
+
+
+class RegexProfiler:
+    # Searches the patterns one by one and records per pattern the cumulative time, the number of calls, the bytes
+    # scanned and the slowest body. Patterns whose cost per byte is more than outlier_factor times the median are
+    # flagged in report(). With a time_budget (seconds per body) the patterns are searched with the regex module,
+    # whose searches can be interrupted: once the budget is used up, the running search is aborted, the remaining
+    # patterns are skipped and the body is recorded as timed out. Can be passed as matcher to apply_regexes, which
+    # then adds a regex_timed_out column if a budget is set and does not memoize the timed out bodies.
+    def __init__(self, regexes, time_budget: float = None, outlier_factor: float = 10.0):
+        if time_budget is not None and time_budget < 0:
+            raise ValueError(f"Time budget must not be negative: {time_budget}")
+        self.regexes = regexes
+        self.time_budget = time_budget
+        self.outlier_factor = outlier_factor
+        self.seconds = np.zeros(len(regexes))
+        self.calls = np.zeros(len(regexes), dtype=np.int64)
+        self.bytes = np.zeros(len(regexes), dtype=np.int64)
+        self.worst_seconds = np.zeros(len(regexes))
+        self.worst_bodies = [None] * len(regexes)
+        self.timed_out = set()
+        self.__interruptible = None if time_budget is None else [_interruptible(pattern['regex']) for pattern in regexes]
+
+    def match(self, content):
+        hits = [False] * len(self.regexes)
+        size = len(content)
+        started = time.perf_counter()
+        for i, pattern in enumerate(self.regexes):
+            before = time.perf_counter()
+            if self.time_budget is None:
+                hits[i] = bool(pattern['regex'].search(content))
+            else:
+                remaining = self.time_budget - (before - started)
+                try:
+                    if remaining <= 0:
+                        raise TimeoutError
+                    hits[i] = bool(self.__interruptible[i].search(content, timeout=remaining))
+                except TimeoutError:
+                    self.timed_out.add(content)
+                    self.__record(i, content, size, time.perf_counter() - before)
+                    break
+            self.__record(i, content, size, time.perf_counter() - before)
+        return tuple(hits)
+
+    def __record(self, i, content, size, elapsed):
+        self.seconds[i] += elapsed
+        self.calls[i] += 1
+        self.bytes[i] += size
+        if elapsed > self.worst_seconds[i]:
+            self.worst_seconds[i] = elapsed
+            self.worst_bodies[i] = content
+
+    def is_timed_out(self, content) -> bool:
+        return content in self.timed_out
+
+    def timed_out_mask(self, content) -> np.ndarray:
+        # rows whose body ran out of time budget
+        if not self.timed_out:
+            return np.zeros(len(content), dtype=bool)
+        return content.isin(self.timed_out).to_numpy()
+
+    def worst_body(self, name: str):
+        return self.worst_bodies[[pattern['name'] for pattern in self.regexes].index(name)]
+
+    def report(self) -> pd.DataFrame:
+        # one row per pattern, most expensive first
+        with np.errstate(divide='ignore', invalid='ignore'):
+            per_megabyte = np.where(self.bytes > 0, self.seconds / self.bytes * 1e6, np.nan)
+        median = np.nanmedian(per_megabyte) if np.isfinite(per_megabyte).any() else np.nan
+        report = pd.DataFrame({
+            'name': [pattern['name'] for pattern in self.regexes],
+            'calls': self.calls,
+            'bytes': self.bytes,
+            'seconds': self.seconds,
+            'seconds_per_mb': per_megabyte,
+            'worst_seconds': self.worst_seconds,
+            'worst_body_length': [len(body) if body is not None else 0 for body in self.worst_bodies],
+            'outlier': per_megabyte > self.outlier_factor * median,
+        })
+        return report.sort_values('seconds', ascending=False, ignore_index=True)
+
+
+def __detect_chunk(content, regexes):
+    # runs in a pool worker (or in process) on an object array of non-null bodies, returns a rows x patterns matrix
+    series = pd.Series(content, dtype=object)
+    matrix = np.empty((len(content), len(regexes)), dtype=bool)
+    with warnings.catch_warnings():
+        # capturing groups are only used for alternation in the notebook patterns
+        warnings.filterwarnings('ignore', 'This pattern is interpreted as a regular expression', UserWarning)
+        for i, pattern in enumerate(regexes):
+            matrix[:, i] = series.str.contains(pattern['regex'], na=False).to_numpy(dtype=bool)
+    return matrix
+
+
+def detect_regexes(traffic, regexes, workers: int = None, chunksize: int = None):
+    # Only the detected_<name> columns, aligned with the index of traffic. Every pattern runs as one Series.str.contains
+    # over the non-null bodies; with workers > 1 the bodies are split into chunks of chunksize that are matched on a
+    # process pool (compiled patterns pickle by source and flags). Missing bodies have no hits.
+    content = traffic['request_content']
+    present = content.notna().to_numpy()
+    values = content.to_numpy(dtype=object)[present]
+    if workers is not None and workers > 1 and len(values):
+        if chunksize is None:
+            chunksize = max(1, -(-len(values) // (workers * 4)))
+        chunks = [values[start:start + chunksize] for start in range(0, len(values), chunksize)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # map yields the results in the order of the chunks
+            hits = np.concatenate(list(executor.map(partial(__detect_chunk, regexes=regexes), chunks)))
+    else:
+        hits = __detect_chunk(values, regexes)
+
+    matrix = np.zeros((len(traffic), len(regexes)), dtype=bool)
+    matrix[present] = hits
+    return pd.DataFrame(matrix, index=traffic.index, columns=[f"detected_{pattern['name']}" for pattern in regexes])
+
+
+def apply_regexes(traffic, regexes, memo=None, matcher=None, engine: str = 'rowwise', workers: int = None,
+                  chunksize: int = None):
+    # With a matcher (e.g. LiteralPrefilter(regexes) or RegexProfiler(regexes)) every body is matched against
+    # all patterns in one call. With a memo (cache_data.ContentMemo) every distinct body is scanned once and the hits
+    # are broadcast to all rows sharing that body, the memo is keyed by the pattern set so results can be reused
+    # across runs. Both produce the same detected_<name> columns as the per-pattern row-wise scan. Engine 'vectorized'
+    # computes the columns with detect_regexes (optionally on workers processes) and joins them to traffic without
+    # copying its columns; it is ignored when a memo or matcher is given.
+    if engine not in ('rowwise', 'vectorized'):
+        raise ValueError(f"Unknown regex engine: {engine}")
+    if engine == 'vectorized' and memo is None and matcher is None:
+        detections = detect_regexes(traffic, regexes, workers, chunksize)
+        return pd.concat([traffic.drop(columns=detections.columns, errors='ignore'), detections], axis=1)
 
+    traffic_copy = traffic.copy()
+    if memo is None and matcher is None:
+        for pattern in regexes:
+            column_name = f"detected_{pattern['name']}"
+            traffic_copy[column_name] = traffic_copy.apply(search_pattern, axis=1, pattern=pattern)
+        return traffic_copy
+
+    search = matcher.match if matcher is not None else partial(__search_all, regexes=regexes)
+    content = traffic_copy['request_content']
+    budgeted = isinstance(matcher, RegexProfiler) and matcher.time_budget is not None
+    if memo is not None:
+        # the truncated hits of a timed out body must not be reused by later exact scans
+        cacheable = (lambda body: not matcher.is_timed_out(body)) if budgeted else None
+        hits = memo.map(content, search, 'apply_regexes:' + regexes_fingerprint(regexes), cacheable)
+    else:
+        present = content.notna().to_numpy()
+        hits = [search(body) if is_present else None for body, is_present in zip(content.to_numpy(dtype=object), present)]
+
+    # missing bodies have no hits
+    no_hits = (False,) * len(regexes)
+    matrix = np.array([row if row is not None else no_hits for row in hits], dtype=bool)
+    matrix = matrix.reshape(len(traffic_copy), len(regexes))
+    for i, pattern in enumerate(regexes):
+        traffic_copy[f"detected_{pattern['name']}"] = matrix[:, i]
+    if budgeted:
+        traffic_copy['regex_timed_out'] = matcher.timed_out_mask(content)
     return traffic_copy
 
 
-def aggregate_pii_by_app(traffic, regexes, is_tracker):
-    # Filter rows based on is_tracker status
-    filtered_traffic = traffic[traffic['is_tracker'] == is_tracker]
+def aggregate_pii(traffic, regexes, by, count, first=(), prefix='detected_', out_prefix=None):
+    # For every value of by (in groupby order, missing keys dropped) and every pattern, the number of distinct values
+    # of count in rows where the <prefix><name> column is truthy. The columns in first are taken from the first row of
+    # each group. All groups and patterns are counted at once from the (row, pattern) pairs of the detection matrix.
+    out_prefix = prefix if out_prefix is None else out_prefix
+    columns = [by] + list(first) + [f"{out_prefix}{pattern['name']}" for pattern in regexes]
+    # rows with a missing key get no group number, -1 here
+    groups = traffic.groupby(by, observed=True, sort=True).ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    valid = groups >= 0
+    if not valid.any():
+        return pd.DataFrame(columns=columns)
+    positions = np.flatnonzero(valid)
+    _, first_index = np.unique(groups[valid], return_index=True)
+    first_rows = positions[first_index]
+    n_groups = len(first_rows)
+
+    # bool semantics of the original per-group filter, which used astype(bool)
+    detected = traffic[[f"{prefix}{pattern['name']}" for pattern in regexes]].astype(bool).to_numpy()
+    others, uniques = pd.factorize(traffic[count])
+    rows, patterns = np.nonzero(detected & (valid & (others >= 0))[:, None])
+    n_patterns, n_others = len(regexes), max(len(uniques), 1)
+    flows = np.unique((groups[rows] * n_patterns + patterns) * n_others + others[rows])
+    counts = np.bincount(flows // n_others, minlength=n_groups * n_patterns).reshape(n_groups, n_patterns)
+
+    # scalars as iloc[0] returns them, so the key and first columns infer the same dtypes as before
+    result = {column: list(traffic[column].iloc[first_rows].to_numpy()) for column in [by] + list(first)}
+    result.update({column: counts[:, i] for i, column in enumerate(columns[1 + len(first):])})
+    return pd.DataFrame(result, columns=columns)
 
-    # Initialize an empty list to store the result rows
-    result_rows = []
 
+def aggregate_pii_by_app(traffic, regexes, is_tracker):
+    # count of distinct hosts per package for each pattern, restricted to tracker or non-tracker traffic
     tracker_string = 'tracker' if is_tracker else 'non_tracker'
-
-    # Group by package_name
-    package_groups = filtered_traffic.groupby('package_name')
-
-    # For each package, calculate the count of distinct hosts for detected PII
-    for package_name, group in package_groups:
-        result_row = {'package_name': package_name}
-        for pattern in regexes:
-            column_name = f"detected_{pattern['name']}"
-            column_name_out = f"detected_{tracker_string}_{pattern['name']}"
-            # Calculate the count of distinct hosts where the PII pattern was detected
-            pii_detected_hosts = group[group[column_name].astype(bool)]['remote_host'].nunique()
-            result_row[column_name_out] = pii_detected_hosts
-        result_rows.append(result_row)
-
-    # Convert the list of dictionaries to a DataFrame
-    result_df = pd.DataFrame(result_rows)
-
-    # Set the column order as package_name followed by detected_ columns
-    column_order = ['package_name'] + [f"detected_{tracker_string}_{pattern['name']}" for pattern in regexes]
-    result_df = result_df[column_order]
-
-    return result_df
+    filtered_traffic = traffic[traffic['is_tracker'] == is_tracker]
+    return aggregate_pii(filtered_traffic, regexes, 'package_name', 'remote_host',
+                         out_prefix=f'detected_{tracker_string}_')
 
 
 def aggregate_pii_by_host(traffic, regexes):
-    # Initialize an empty list to store the result rows
-    result_rows = []
-
-    # Group by remote_host
-    host_groups = traffic.groupby('remote_host')
-
-    # For each remote host, calculate the count of distinct package_names for detected PII
-    for remote_host, group in host_groups:
-        result_row = {'remote_host': remote_host, 'remote_domain': group['remote_domain'].iloc[0],
-                      'is_tracker': group['is_tracker'].iloc[0]}
-        for pattern in regexes:
-            column_name = f"detected_{pattern['name']}"
-            # Calculate the count of distinct package_names where the PII pattern was detected
-            pii_detected_packages = group[group[column_name].astype(bool)]['package_name'].nunique()
-            result_row[column_name] = pii_detected_packages
-        result_rows.append(result_row)
-
-    # Convert the list of dictionaries to a DataFrame
-    result_df = pd.DataFrame(result_rows)
-
-    # Set the column order as remote_host, is_tracker followed by detected_ columns
-    column_order = ['remote_host', 'remote_domain', 'is_tracker'] + [f"detected_{pattern['name']}" for pattern in
-                                                                     regexes]
-    result_df = result_df.reindex(columns=column_order)
-
-    return result_df
+    # count of distinct packages per remote host for each pattern
+    return aggregate_pii(traffic, regexes, 'remote_host', 'package_name', first=('remote_domain', 'is_tracker'))
 
 
 def aggregate_pii_by_domain(traffic, regexes):
-    # Initialize an empty list to store the result rows
-    result_rows = []
-
-    # Group by remote_host
-    domain_groups = traffic.groupby('remote_domain')
-
-    # For each remote host, calculate the count of distinct package_names for detected PII
-    for domain, group in domain_groups:
-        result_row = {'remote_domain': domain, 'is_tracker': group['is_tracker'].iloc[0]}
-        for pattern in regexes:
-            column_name = f"detected_{pattern['name']}"
-            # Calculate the count of distinct package_names where the PII pattern was detected
-            pii_detected_packages = group[group[column_name].astype(bool)]['package_name'].nunique()
-            result_row[column_name] = pii_detected_packages
-        result_rows.append(result_row)
-
-    # Convert the list of dictionaries to a DataFrame
-    result_df = pd.DataFrame(result_rows)
-
-    # Set the column order as remote_host, is_tracker followed by detected_ columns
-    column_order = ['remote_domain', 'is_tracker'] + [f"detected_{pattern['name']}" for pattern in regexes]
-    result_df = result_df.reindex(columns=column_order)
-
-    return result_df
+    # count of distinct packages per remote domain for each pattern
+    return aggregate_pii(traffic, regexes, 'remote_domain', 'package_name', first=('is_tracker',))
 
 
 def is_ip_address(host):
@@ -165,38 +466,41 @@ def to_snake_case(string):
     return string.lower().replace(" ", "_").replace("-", "_").replace(".", "_")
 
 
-def data_safety_to_dataframe(data_safety):
-    # First, find all unique data points across all apps
-    all_data_points = aggregate_data_safety_types(data_safety)
-
-    # Initialize empty DataFrame with columns for pkg, data_deletable, data_encrypted, independently_reviewed
-    df_cols = ['pkg', 'data_deletable', 'data_encrypted', 'independently_reviewed']
-    df_cols += [f'collected_{point}' for point in all_data_points]
-    df_cols += [f'shared_{point}' for point in all_data_points]
-    apps_df = pd.DataFrame(columns=df_cols)
-
-    # Iterate through each app in the data_safety list
-    for app in data_safety:
-        app_row = {col: False for col in df_cols}  # Initialize all data points to False
-        app_row['pkg'] = app['pkg']
-        app_row['data_deletable'] = app['data_deletable']
-        app_row['data_encrypted'] = app['data_encrypted']
-        app_row['independently_reviewed'] = app['independently_reviewed']
-
-        # Mark collected data points as True
-        for collected in app.get('collected_data', []):
-            for data in collected.get('data', []):
-                col_name = f'collected_{data["data"]}'
-                app_row[col_name] = True
-
-        # Mark shared data points as True
-        for shared in app.get('shared_data', []):
-            for data in shared.get('data', []):
-                col_name = f'shared_{data["data"]}'
-                app_row[col_name] = True
-
-        # Append the app's row to the DataFrame
-        app_df = pd.DataFrame([app_row], columns=df_cols)
-        apps_df = pd.concat([apps_df, app_df], ignore_index=True)
-
-    return apps_df
+def data_safety_to_dataframe(data_safety, sparse=False):
+    # One pass over the data-handling entries collects the (app, column) pair of every declared data point, the
+    # collected_<point> and shared_<point> flags are then set in a single boolean matrix. Data points are ordered by
+    # first appearance (shared before collected within an app). With sparse=True the flag columns are stored as
+    # sparse booleans, one column at a time, which keeps the full Play Store dump small in memory.
+    info_cols = ['pkg', 'data_deletable', 'data_encrypted', 'independently_reviewed']
+    info = {col: [] for col in info_cols}
+    points = {}
+    rows, point_ids, is_shared = [], [], []
+    for row, app in enumerate(data_safety):
+        for col in info_cols:
+            info[col].append(app.get(col))
+        for key, shared in (('shared_data', True), ('collected_data', False)):
+            for entry in app.get(key, []):
+                for data in entry.get('data', []):
+                    rows.append(row)
+                    point_ids.append(points.setdefault(data['data'], len(points)))
+                    is_shared.append(shared)
+
+    # collected_ columns for all data points come first, then the shared_ columns
+    n_apps, n_points = len(info['pkg']), len(points)
+    flag_cols = [f'collected_{point}' for point in points] + [f'shared_{point}' for point in points]
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(point_ids, dtype=np.int64) + n_points * np.array(is_shared, dtype=np.int64)
+    if sparse:
+        order = np.argsort(cols, kind='stable')
+        bounds = np.searchsorted(cols[order], np.arange(len(flag_cols) + 1))
+        flags = {}
+        for i, col in enumerate(flag_cols):
+            values = np.zeros(n_apps, dtype=bool)
+            values[rows[order[bounds[i]:bounds[i + 1]]]] = True
+            flags[col] = pd.arrays.SparseArray(values, fill_value=False)
+        flags = pd.DataFrame(flags, index=pd.RangeIndex(n_apps), columns=flag_cols)
+    else:
+        matrix = np.zeros((n_apps, len(flag_cols)), dtype=bool)
+        matrix[rows, cols] = True
+        flags = pd.DataFrame(matrix, columns=flag_cols)
+    return pd.concat([pd.DataFrame(info, columns=info_cols), flags], axis=1)
@@ -0,0 +1,148 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+INDEX_VERSION = 1
+
+
+def _codes(series):
+    # integer codes and the list of distinct values, missing values get code -1
+    codes, uniques = pd.factorize(series)
+    return codes.astype(np.int32), [None if pd.isna(value) else value for value in np.asarray(uniques, dtype=object)]
+
+
+def _lookup(values, codes):
+    # codes back to values, -1 to None
+    values = np.array(list(values) + [None], dtype=object)
+    return values[codes]
+
+
+class PiiIndex:
+    # Inverted index from each pattern to the requests it was detected in. The hits of a pattern are stored as
+    # compact arrays (row position, app, host and domain codes) and partitioned by tracker class and crawl, so a query
+    # only slices the arrays of the partitions it asks for. Built once after detection from the detected_<name>
+    # columns (or any other prefix, e.g. 'ai_detected_'), and saved to / loaded from a directory with the arrays in
+    # an .npz file and the names and value lists in meta.json.
+    def __init__(self, names, apps, hosts, domains, crawls, rows, app_codes, host_codes, domain_codes, bounds):
+        self.names = list(names)
+        self.apps = list(apps)
+        self.hosts = list(hosts)
+        self.domains = list(domains)
+        self.crawls = list(crawls)
+        self.hit_rows = rows
+        self.app_codes = app_codes
+        self.host_codes = host_codes
+        self.domain_codes = domain_codes
+        # the hits of partition k, a flat (pattern, tracker class, crawl) number, are hit_rows[bounds[k]:bounds[k + 1]]
+        self.bounds = bounds
+        self.__positions = {name: i for i, name in enumerate(self.names)}
+
+    @classmethod
+    def build(cls, traffic, names, prefix: str = 'detected_', crawl_column: str = 'crawl'):
+        flags = (traffic[[f'{prefix}{name}' for name in names]] == True).to_numpy()
+        apps, app_values = _codes(traffic['package_name'])
+        hosts, host_values = _codes(traffic['remote_host'])
+        domains, domain_values = _codes(traffic['remote_domain'])
+        tracker = (traffic['is_tracker'] == True).to_numpy().astype(np.int64)
+        if crawl_column in traffic.columns:
+            crawls, crawl_values = pd.factorize(traffic[crawl_column], use_na_sentinel=False)
+            crawl_values = [None if pd.isna(value) else value for value in np.asarray(crawl_values, dtype=object)]
+        else:
+            crawls, crawl_values = np.zeros(len(traffic), dtype=np.int64), [None]
+
+        # every hit gets the flat number of its (pattern, tracker class, crawl) partition, sorting by it groups them
+        rows, patterns = np.nonzero(flags)
+        n_partitions = 2 * len(crawl_values)
+        partitions = patterns * n_partitions + tracker[rows] * len(crawl_values) + crawls[rows]
+        order = np.argsort(partitions, kind='stable')
+        rows, partitions = rows[order], partitions[order]
+        bounds = np.searchsorted(partitions, np.arange(len(names) * n_partitions + 1))
+        return cls(names, app_values, host_values, domain_values, crawl_values, rows.astype(np.int64),
+                   apps[rows], hosts[rows], domains[rows], bounds.astype(np.int64))
+
+    def __partitions(self, pattern: str, tracker=None, crawl=None):
+        # the flat partition numbers of a pattern, optionally restricted to a tracker class and/or crawl
+        if pattern not in self.__positions:
+            raise KeyError(f"Unknown pattern: {pattern}")
+        if crawl is not None and crawl not in self.crawls:
+            raise KeyError(f"Unknown crawl: {crawl}")
+        trackers = [0, 1] if tracker is None else [int(bool(tracker))]
+        crawls = range(len(self.crawls)) if crawl is None else [self.crawls.index(crawl)]
+        base = self.__positions[pattern] * 2 * len(self.crawls)
+        return [(base + t * len(self.crawls) + c, t, c) for t in trackers for c in crawls]
+
+    def __slices(self, pattern, tracker, crawl):
+        return [(slice(self.bounds[k], self.bounds[k + 1]), t, c) for k, t, c in
+                self.__partitions(pattern, tracker, crawl)]
+
+    def rows(self, pattern: str, tracker=None, crawl=None) -> np.ndarray:
+        # row positions in the traffic frame the index was built from
+        return np.sort(np.concatenate([self.hit_rows[s] for s, _, _ in self.__slices(pattern, tracker, crawl)]))
+
+    def count(self, pattern: str, tracker=None, crawl=None) -> int:
+        return int(sum(s.stop - s.start for s, _, _ in self.__slices(pattern, tracker, crawl)))
+
+    def flows(self, pattern: str, tracker=None, crawl=None, app: str = None) -> pd.DataFrame:
+        # distinct (app, host) flows of a pattern with the number of requests, most requests first
+        parts = self.__slices(pattern, tracker, crawl)
+        apps = np.concatenate([self.app_codes[s] for s, _, _ in parts])
+        hosts = np.concatenate([self.host_codes[s] for s, _, _ in parts])
+        domains = np.concatenate([self.domain_codes[s] for s, _, _ in parts])
+        trackers = np.concatenate([np.full(s.stop - s.start, t) for s, t, _ in parts])
+        crawls = np.concatenate([np.full(s.stop - s.start, c) for s, _, c in parts])
+        if app is not None:
+            keep = apps == (self.apps.index(app) if app in self.apps else -2)
+            apps, hosts, domains, trackers, crawls = (a[keep] for a in (apps, hosts, domains, trackers, crawls))
+
+        keys, requests = np.unique(np.stack([apps, hosts, domains, trackers, crawls], axis=1), axis=0,
+                                   return_counts=True)
+        flows = pd.DataFrame({
+            'package_name': _lookup(self.apps, keys[:, 0]),
+            'remote_host': _lookup(self.hosts, keys[:, 1]),
+            'remote_domain': _lookup(self.domains, keys[:, 2]),
+            'is_tracker': keys[:, 3].astype(bool),
+            'crawl': _lookup(self.crawls, keys[:, 4]),
+            'requests': requests,
+        })
+        if self.crawls == [None]:
+            flows = flows.drop(columns='crawl')
+        return flows.sort_values(['requests', 'package_name', 'remote_host'], ascending=[False, True, True],
+                                 ignore_index=True)
+
+    def apps_for(self, pattern: str, tracker=None, crawl=None):
+        codes = np.unique(np.concatenate([self.app_codes[s] for s, _, _ in self.__slices(pattern, tracker, crawl)]))
+        return sorted(self.apps[code] for code in codes if code >= 0)
+
+    def hosts_for(self, pattern: str, tracker=None, crawl=None):
+        codes = np.unique(np.concatenate([self.host_codes[s] for s, _, _ in self.__slices(pattern, tracker, crawl)]))
+        return sorted(self.hosts[code] for code in codes if code >= 0)
+
+    def summary(self) -> pd.DataFrame:
+        # requests, apps and hosts per pattern and tracker class
+        records = []
+        for name in self.names:
+            for tracker in (False, True):
+                records.append({'pattern': name, 'is_tracker': tracker, 'requests': self.count(name, tracker),
+                                'apps': len(self.apps_for(name, tracker)), 'hosts': len(self.hosts_for(name, tracker))})
+        return pd.DataFrame(records)
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        np.savez(os.path.join(path, 'arrays.npz'), rows=self.hit_rows, app_codes=self.app_codes,
+                 host_codes=self.host_codes, domain_codes=self.domain_codes, bounds=self.bounds)
+        meta = {'version': INDEX_VERSION, 'names': self.names, 'apps': self.apps, 'hosts': self.hosts,
+                'domains': self.domains, 'crawls': self.crawls}
+        with open(os.path.join(path, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(os.path.join(path, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError(f"Unsupported index version: {meta.get('version')}")
+        with np.load(os.path.join(path, 'arrays.npz')) as arrays:
+            return cls(meta['names'], meta['apps'], meta['hosts'], meta['domains'], meta['crawls'], arrays['rows'],
+                       arrays['app_codes'], arrays['host_codes'], arrays['domain_codes'], arrays['bounds'])
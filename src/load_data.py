@@ -1,7 +1,15 @@
+import hashlib
 import json
+import os
 import sqlite3
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import cached_property
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from tld import get_fld
+from .cache_data import DataCache
 
 
 def parse_domain(remote_host):
@@ -11,27 +19,478 @@ def parse_domain(remote_host):
     return domain
 
 
+# older SQLite builds allow at most 999 bound variables per statement, larger filters go through a temp table
+MAX_BOUND_PACKAGES = 999
+
+
+def _quote_identifier(name: str) -> str:
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _package_filter(conn, packages):
+    # returns the SQL for "package_name IN (...)" and its parameters, the package names are never formatted into the SQL
+    packages = sorted(set(packages))
+    if len(packages) <= MAX_BOUND_PACKAGES:
+        return 'package_name IN ({})'.format(', '.join('?' * len(packages))), packages
+    conn.execute('CREATE TEMP TABLE IF NOT EXISTS study_packages (package_name TEXT PRIMARY KEY)')
+    conn.execute('DELETE FROM temp.study_packages')
+    conn.executemany('INSERT INTO temp.study_packages VALUES (?)', [(package,) for package in packages])
+    return 'package_name IN (SELECT package_name FROM temp.study_packages)', []
+
+
+def table_columns(conn, table: str):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({_quote_identifier(table)})')]
+
+
+def read_packages(conn, table: str, packages, columns=None, chunksize: int = None, after: tuple = None):
+    # SELECT the given columns of table for the given packages (all rows if packages is None), optionally only rows
+    # whose column after[0] is greater than after[1]. With a chunksize an iterator of DataFrames is returned (as with
+    # pd.read_sql_query), its chunks carry consecutive row labels so they concatenate to the full read.
+    available = table_columns(conn, table)
+    if columns is None:
+        projection = '*'
+    else:
+        unknown = [column for column in columns if column not in available]
+        if unknown:
+            raise ValueError(f"Unknown columns for {table}: {', '.join(unknown)}")
+        projection = ', '.join(_quote_identifier(column) for column in columns)
+    conditions, params = [], []
+    if packages is not None:
+        where, params = _package_filter(conn, packages)
+        conditions.append(where)
+    if after is not None:
+        column, value = after
+        if column not in available:
+            raise ValueError(f"Unknown columns for {table}: {column}")
+        conditions.append(f'{_quote_identifier(column)} > ?')
+        params.append(value)
+    query = f'SELECT {projection} FROM {_quote_identifier(table)}'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+    if chunksize is None:
+        return pd.read_sql_query(query, conn, params=params)
+    return _relabel_chunks(pd.read_sql_query(query, conn, params=params, chunksize=chunksize))
+
+
+def _relabel_chunks(chunks):
+    offset = 0
+    for chunk in chunks:
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        offset += len(chunk)
+        yield chunk
+
+
+# low-cardinality columns that are stored as categoricals in compact traffic frames
+KEY_COLUMNS = ('package_name', 'remote_host', 'remote_domain')
+
+
+def compact_traffic(traffic: pd.DataFrame, categories: dict = None) -> pd.DataFrame:
+    # converts the key columns to categoricals (optionally with given categories) and is_tracker to int8, in place
+    categories = categories or {}
+    for column in KEY_COLUMNS:
+        if column in traffic.columns:
+            traffic[column] = pd.Categorical(traffic[column], categories=categories.get(column))
+    if 'is_tracker' in traffic.columns:
+        traffic['is_tracker'] = traffic['is_tracker'].astype('int8')
+    return traffic
+
+
+def concat_crawls(frames: dict) -> pd.DataFrame:
+    # Concatenates the traffic of several crawls ({crawl id: frame}) into one compact frame, in the given order.
+    # All frames share the same categories, so the key columns stay categorical and every row is tagged with a
+    # categorical crawl column.
+    categories = {}
+    for column in KEY_COLUMNS:
+        values = [pd.Series(df[column].unique()) for df in frames.values() if column in df.columns]
+        if values:
+            categories[column] = pd.Index(pd.concat(values).dropna().unique()).sort_values()
+    crawls = list(frames)
+    parts = []
+    for code, (crawl, df) in enumerate(frames.items()):
+        df = compact_traffic(df, categories)
+        df['crawl'] = pd.Categorical.from_codes(np.full(len(df), code, dtype='int8'), categories=crawls)
+        parts.append(df)
+    return pd.concat(parts, axis=0, ignore_index=True)
+
+
+def crawl_rows(traffic: pd.DataFrame, crawl: str) -> pd.DataFrame:
+    # Returns the contiguous block of rows of one crawl in a frame built by concat_crawls. The rows are sliced, not
+    # copied, and relabelled from 0 like a separately loaded frame.
+    positions = np.flatnonzero((traffic['crawl'] == crawl).to_numpy())
+    if len(positions) == 0:
+        return traffic.iloc[0:0]
+    rows = traffic.iloc[positions[0]:positions[-1] + 1]
+    if len(rows) != len(positions):
+        raise ValueError(f"Rows of crawl {crawl} are not contiguous")
+    rows.index = pd.RangeIndex(len(rows))
+    return rows
+
+
+def connect_read_only(db_path: str):
+    return sqlite3.connect('file:{}?mode=ro'.format(urllib.parse.quote(os.path.abspath(db_path))), uri=True)
+
+
+def _read_crawl(db_path: str, table: str, packages, columns):
+    # runs in a pool worker, every worker reads through its own read-only connection
+    conn = connect_read_only(db_path)
+    try:
+        return read_packages(conn, table, packages, columns)
+    finally:
+        conn.close()
+
+
+def load_crawls(crawls, packages=None, trackers=None, columns=None, max_workers: int = None,
+                use_processes: bool = False, table: str = 'JoinedRequest') -> pd.DataFrame:
+    # Loads the traffic of any number of crawl databases concurrently into one compact frame (see concat_crawls).
+    # crawls is either {crawl id: db path} or a list of db paths, whose file names then serve as crawl ids.
+    # The tracker classification runs once over the combined frame, so every distinct host is parsed only once.
+    if not isinstance(crawls, dict):
+        crawls = {os.path.splitext(os.path.basename(path))[0]: path for path in crawls}
+    if len(crawls) == 0:
+        raise ValueError("No crawl databases given")
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    with executor_class(max_workers=max_workers or len(crawls)) as executor:
+        futures = {crawl: executor.submit(_read_crawl, path, table, packages, columns) for crawl, path in crawls.items()}
+        frames = {crawl: future.result() for crawl, future in futures.items()}
+
+    traffic = concat_crawls(frames)
+    if trackers is not None and 'remote_host' in traffic.columns:
+        traffic = compact_traffic(trackers.annotate(traffic))
+        # keep the crawl tag as the last column
+        traffic['crawl'] = traffic.pop('crawl')
+    return traffic
+
+
+class TrackerClassifier:
+    # Classifies remote hosts against a tracker domain list. Every distinct host is parsed only once and the
+    # per-host results are broadcast back onto the traffic frame through its factorized codes.
+    def __init__(self, tracker_domains, match_parent_domains: bool = True):
+        self.domains = frozenset(tracker_domains)
+        self.match_parent_domains = match_parent_domains
+
+    @classmethod
+    def from_file(cls, tracker_domains_path: str, match_parent_domains: bool = True):
+        with open(tracker_domains_path, 'r') as file:
+            return cls(file.read().splitlines(), match_parent_domains=match_parent_domains)
+
+    def fingerprint(self) -> str:
+        payload = json.dumps({'domains': sorted(self.domains), 'match_parent_domains': self.match_parent_domains})
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def is_tracker_host(self, remote_host, remote_domain) -> bool:
+        if remote_domain in self.domains:
+            return True
+        if not self.match_parent_domains or not isinstance(remote_host, str):
+            return False
+        # walk the suffixes of the host (a.b.example.com, b.example.com, ...) down to the registered domain
+        labels = remote_host.split('.')
+        for i in range(len(labels) - 1):
+            suffix = '.'.join(labels[i:])
+            if suffix in self.domains:
+                return True
+            if suffix == remote_domain:
+                break
+        return False
+
+    def classify_hosts(self, hosts):
+        # returns (remote_domain, is_tracker) for a sequence of distinct hosts
+        domains = [parse_domain(host) if isinstance(host, str) else host for host in hosts]
+        is_tracker = [self.is_tracker_host(host, domain) for host, domain in zip(hosts, domains)]
+        return domains, np.array(is_tracker, dtype=bool)
+
+    def classify(self, remote_hosts: pd.Series) -> pd.DataFrame:
+        codes, uniques = pd.factorize(remote_hosts)
+        domains, is_tracker = self.classify_hosts(list(uniques))
+
+        # code -1 marks missing hosts, indexing with it picks the appended (None, False) entry
+        domains = np.array(domains + [None], dtype=object)
+        is_tracker = np.append(is_tracker, False)
+        return pd.DataFrame({
+            'remote_domain': domains[codes],
+            'is_tracker': is_tracker[codes].astype(int),
+        }, index=remote_hosts.index)
+
+    def annotate(self, traffic: pd.DataFrame) -> pd.DataFrame:
+        classified = self.classify(traffic['remote_host'])
+        traffic['remote_domain'] = classified['remote_domain']
+        traffic['is_tracker'] = classified['is_tracker']
+        return traffic
+
+
+class _GrowingFrame:
+    # Rows appended part by part that are read as one frame without concatenating all parts again. numpy columns
+    # live in buffers that grow by doubling, Arrow-backed columns (e.g. the str dtype of pandas 3) as a list of Arrow
+    # chunks, so frame() shares their memory and an append only copies the new rows. A part whose columns or dtypes
+    # differ from the earlier ones is merged with pd.concat once, columns of other extension dtypes on every frame().
+    def __init__(self):
+        self.__clear()
+
+    def __clear(self):
+        self.rows = 0
+        self.__dtypes = None
+        self.__buffers = {}
+        self.__chunks = {}
+        self.__others = {}
+        self.__frame = None
+
+    def append(self, part: pd.DataFrame):
+        if self.__dtypes is None:
+            self.__dtypes = part.dtypes.to_dict()
+        elif list(part.columns) != list(self.__dtypes) or any(part[column].dtype != dtype
+                                                              for column, dtype in self.__dtypes.items()):
+            merged = pd.concat([self.frame(), part], axis=0, ignore_index=True)
+            self.__clear()
+            self.append(merged)
+            return
+        for column, dtype in self.__dtypes.items():
+            values = part[column].array
+            if isinstance(dtype, np.dtype):
+                self.__append_buffer(column, part[column].to_numpy(dtype=dtype))
+            elif hasattr(dtype, '__from_arrow__') and hasattr(values, '__arrow_array__'):
+                array = pa.array(values)
+                chunks = self.__chunks.setdefault(column, [])
+                arrow_type = chunks[0].type if chunks else array.type
+                for chunk in (array.chunks if isinstance(array, pa.ChunkedArray) else [array]):
+                    chunks.append(chunk if chunk.type == arrow_type else chunk.cast(arrow_type))
+            else:
+                self.__others.setdefault(column, []).append(part[column])
+        self.rows += len(part)
+        self.__frame = None
+
+    def __append_buffer(self, column, values: np.ndarray):
+        buffer = self.__buffers.get(column)
+        needed = self.rows + len(values)
+        if buffer is None or len(buffer) < needed:
+            grown = np.empty(max(needed, 2 * (len(buffer) if buffer is not None else 0)), dtype=values.dtype)
+            if buffer is not None:
+                grown[:self.rows] = buffer[:self.rows]
+            self.__buffers[column] = buffer = grown
+        # frames returned earlier only see rows[:their length], so writing past it does not change them
+        buffer[self.rows:needed] = values
+
+    def frame(self) -> pd.DataFrame:
+        if self.__frame is None:
+            columns = {}
+            for column, dtype in self.__dtypes.items():
+                if column in self.__buffers:
+                    columns[column] = self.__buffers[column][:self.rows]
+                elif column in self.__chunks:
+                    columns[column] = dtype.__from_arrow__(pa.chunked_array(self.__chunks[column]))
+                else:
+                    columns[column] = pd.concat(self.__others[column], ignore_index=True).array
+            self.__frame = pd.DataFrame(columns, index=pd.RangeIndex(self.rows), copy=False)
+        return self.__frame
+
+
+class IncrementalTrafficLoader:
+    # Keeps the traffic of a crawl database that is still being appended to up to date. refresh() only fetches the
+    # rows whose watermark_column (an increasing id or timestamp of JoinedRequest) lies past the high-water mark of
+    # the previous refresh, classifies just those rows and appends them. With a DataCache the appended parts and
+    # thereby the mark survive restarts, every refresh writes only its new rows, and once there are more than
+    # max_parts parts they are merged into one.
+    def __init__(self, db_path: str, packages=None, trackers: TrackerClassifier = None, watermark_column: str = 'id',
+                 cache: DataCache = None, table: str = 'JoinedRequest', max_parts: int = 16):
+        self.db_path = db_path
+        self.packages = packages
+        self.trackers = trackers
+        self.watermark_column = watermark_column
+        self.table = table
+        self.cache = cache
+        self.max_parts = max_parts
+        self.watermark = None
+        self.__rows = _GrowingFrame()
+        self.__cache_key = None
+        if cache is not None:
+            # keyed by the database path rather than its fingerprint, the database is expected to grow
+            self.__cache_key = cache.key({}, incremental=True, db_path=os.path.abspath(db_path), table=table,
+                                         watermark_column=watermark_column,
+                                         packages=sorted(packages) if packages is not None else None,
+                                         trackers=trackers.fingerprint() if trackers is not None else None)
+            for part in cache.tables(self.__cache_key):
+                self.__append(cache.load(self.__cache_key, part))
+
+    def __append(self, rows: pd.DataFrame):
+        if self.watermark is not None:
+            # parts left over by an interrupted merge repeat rows the merged part already holds
+            rows = rows[rows[self.watermark_column] > self.watermark]
+        if len(rows) == 0:
+            return
+        self.__rows.append(rows)
+        watermark = rows[self.watermark_column].max()
+        # numpy scalars cannot be bound as SQLite parameters
+        self.watermark = watermark.item() if hasattr(watermark, 'item') else watermark
+
+    def refresh(self) -> int:
+        after = (self.watermark_column, self.watermark) if self.watermark is not None else None
+        conn = connect_read_only(self.db_path)
+        try:
+            rows = read_packages(conn, self.table, self.packages, after=after)
+        finally:
+            conn.close()
+        if len(rows) == 0:
+            return 0
+        if self.trackers is not None:
+            rows = self.trackers.annotate(rows)
+        self.__append(rows)
+        if self.cache is not None:
+            parts = self.cache.tables(self.__cache_key)
+            self.cache.store(self.__cache_key, 'part_{:06d}'.format(len(parts)), rows)
+            if len(parts) + 1 > self.max_parts:
+                self.__merge_parts(parts + ['part_{:06d}'.format(len(parts))])
+        return len(rows)
+
+    def __merge_parts(self, parts):
+        # the merged rows replace the first part before the others are removed, a merge that is interrupted in between
+        # only leaves rows behind that __append skips on the next start
+        self.cache.store(self.__cache_key, parts[0], self.traffic)
+        for part in parts[1:]:
+            self.cache.remove(self.__cache_key, part)
+
+    @property
+    def traffic(self) -> pd.DataFrame:
+        if self.__rows.rows == 0:
+            return pd.DataFrame()
+        return self.__rows.frame()
+
+
 class DataLoader:
-    def __init__(self, db_path_auto: str, db_path_manual: str, json_path_data_handling: str, manual_log_path: str, tracker_domains_path: str):
+    TABLES = ('traffic_auto', 'traffic_manual', 'third_party', 'permissions')
+
+    def __init__(self, db_path_auto: str, db_path_manual: str, json_path_data_handling: str, manual_log_path: str, tracker_domains_path: str,
+                 match_parent_domains: bool = False, cache_dir: str = None, cache_max_bytes: int = 8 * 1024 ** 3,
+                 tables=None, compact: bool = False):
+        self.db_path_auto = db_path_auto
+        self.db_path_manual = db_path_manual
         self.tracker_domains_path = tracker_domains_path
-        self.__conn_auto = sqlite3.connect(db_path_auto)
-        self.__conn_manual = sqlite3.connect(db_path_manual)
+        # compact frames hold every crawl once: traffic_manual is a single frame of the manual and automated crawl
+        # (tagged by a crawl column) and traffic_auto is a view on its automated rows
+        self.compact = compact
+        # exact registered-domain matching by default, so results stay comparable to earlier runs
+        self.trackers = TrackerClassifier.from_file(tracker_domains_path, match_parent_domains=match_parent_domains)
         self.apps = pd.read_csv(manual_log_path)
-        self.__apps_string = ', '.join(['"{}"'.format(value) for value in set(self.apps['package_name'])])
+        self.packages = list(set(self.apps['package_name']))
         self.data_handling = self.__load_data_handling(json_path_data_handling)
-        self.traffic_auto = self.__load_traffic_auto()
-        self.traffic_manual = self.__load_traffic_manual()
-        self.third_party = self.__load_3p()
-        self.permissions = self.__load_perms()
-
-        self.auto_domain_count = len(set(self.traffic_auto['remote_domain']))
-        self.manual_domain_count = len(set(self.traffic_manual['remote_domain']))
-        self.auto_tracker_domain_count = len(set(self.traffic_auto[self.traffic_auto['is_tracker'] == 1]['remote_domain']))
-        self.manual_tracker_domain_count = len(set(self.traffic_manual[self.traffic_manual['is_tracker'] == 1]['remote_domain']))
-        self.auto_host_count = len(set(self.traffic_auto['remote_host']))
-        self.manual_host_count = len(set(self.traffic_manual['remote_host']))
-        self.auto_tracker_host_count = len(set(self.traffic_auto[self.traffic_auto['is_tracker'] == 1]['remote_host']))
-        self.manual_tracker_host_count = len(set(self.traffic_manual[self.traffic_manual['is_tracker'] == 1]['remote_host']))
+
+        # derived tables are cached under a key built from the fingerprints of every source file
+        self.cache = None
+        self.__cache_key = None
+        if cache_dir is not None:
+            self.cache = DataCache(cache_dir, max_bytes=cache_max_bytes)
+            self.__cache_key = self.cache.key({
+                'db_auto': db_path_auto,
+                'db_manual': db_path_manual,
+                'data_handling': json_path_data_handling,
+                'manual_log': manual_log_path,
+                'tracker_domains': tracker_domains_path,
+            }, match_parent_domains=match_parent_domains, compact=compact)
+
+        # tables and statistics are loaded on first access, tables listed here are loaded right away
+        self.load(tables or ())
+
+    def load(self, tables=TABLES):
+        unknown = set(tables) - set(self.TABLES)
+        if unknown:
+            raise ValueError(f"Unknown tables: {', '.join(sorted(unknown))}")
+        for table in tables:
+            getattr(self, table)
+        return self
+
+    def loaded_tables(self):
+        return [table for table in self.TABLES if table in self.__dict__]
+
+    @cached_property
+    def __conn_auto(self):
+        return sqlite3.connect(self.db_path_auto)
+
+    @cached_property
+    def __conn_manual(self):
+        return sqlite3.connect(self.db_path_manual)
+
+    @cached_property
+    def traffic_auto(self):
+        if self.compact:
+            return crawl_rows(self.__traffic_combined, 'auto')
+        return self.__cached('traffic_auto', self.__load_traffic_auto)
+
+    @cached_property
+    def traffic_manual(self):
+        if self.compact:
+            return self.__traffic_combined
+        return self.__cached('traffic_manual', self.__load_traffic_manual)
+
+    @cached_property
+    def __traffic_combined(self):
+        return self.__cached('traffic_combined', self.__load_traffic_combined)
+
+    @cached_property
+    def third_party(self):
+        return self.__cached('third_party', self.__load_3p)
+
+    @cached_property
+    def permissions(self):
+        return self.__cached('permissions', self.__load_perms)
+
+    @staticmethod
+    def __count_distinct(traffic: pd.DataFrame, column: str, trackers_only: bool = False) -> int:
+        values = traffic.loc[traffic['is_tracker'] == 1, column] if trackers_only else traffic[column]
+        return values.nunique(dropna=False)
+
+    @cached_property
+    def auto_domain_count(self):
+        return self.__count_distinct(self.traffic_auto, 'remote_domain')
+
+    @cached_property
+    def manual_domain_count(self):
+        return self.__count_distinct(self.traffic_manual, 'remote_domain')
+
+    @cached_property
+    def auto_tracker_domain_count(self):
+        return self.__count_distinct(self.traffic_auto, 'remote_domain', trackers_only=True)
+
+    @cached_property
+    def manual_tracker_domain_count(self):
+        return self.__count_distinct(self.traffic_manual, 'remote_domain', trackers_only=True)
+
+    @cached_property
+    def auto_host_count(self):
+        return self.__count_distinct(self.traffic_auto, 'remote_host')
+
+    @cached_property
+    def manual_host_count(self):
+        return self.__count_distinct(self.traffic_manual, 'remote_host')
+
+    @cached_property
+    def auto_tracker_host_count(self):
+        return self.__count_distinct(self.traffic_auto, 'remote_host', trackers_only=True)
+
+    @cached_property
+    def manual_tracker_host_count(self):
+        return self.__count_distinct(self.traffic_manual, 'remote_host', trackers_only=True)
+
+    def __cached(self, table: str, load):
+        if self.cache is None:
+            return load()
+        df = self.cache.load(self.__cache_key, table)
+        if df is None:
+            df = load()
+            self.cache.store(self.__cache_key, table, df)
+        return df
+
+    def invalidate_cache(self):
+        if self.cache is not None:
+            self.cache.invalidate(self.__cache_key)
+
+    def iter_traffic(self, crawl: str = 'auto', columns=None, chunksize: int = 100_000):
+        # Streams JoinedRequest of one crawl ('auto' or 'manual', the latter without the automated rows that
+        # traffic_manual appends) in chunks. Chunks are annotated with remote_domain and is_tracker whenever the
+        # projection includes remote_host.
+        connections = {'auto': self.__conn_auto, 'manual': self.__conn_manual}
+        if crawl not in connections:
+            raise ValueError(f"Unknown crawl: {crawl}")
+        for chunk in read_packages(connections[crawl], 'JoinedRequest', self.packages, columns, chunksize):
+            if 'remote_host' in chunk.columns:
+                chunk = self.trackers.annotate(chunk)
+            yield chunk
 
     def __load_data_handling(self, json_path_data_handling: str):
         with open(json_path_data_handling, 'r') as file:
@@ -50,29 +509,22 @@ class DataLoader:
         return apps_combined
 
     def __load_traffic_auto(self):
-        query = 'SELECT * FROM JoinedRequest WHERE package_name IN (%s)' % self.__apps_string
-        df = pd.read_sql_query(query, self.__conn_auto)
-        df['remote_domain'] = df['remote_host'].apply(parse_domain)
-        with open(self.tracker_domains_path, 'r') as file:
-            domains = file.read().splitlines()
-            df['is_tracker'] = df['remote_domain'].apply(lambda x: 1 if x in domains else 0)
-        return df
+        df = read_packages(self.__conn_auto, 'JoinedRequest', self.packages)
+        return self.trackers.annotate(df)
 
     def __load_traffic_manual(self):
-        query = 'SELECT * FROM JoinedRequest WHERE package_name IN (%s)' % self.__apps_string
-        df = pd.read_sql_query(query, self.__conn_manual)
-        df['remote_domain'] = df['remote_host'].apply(parse_domain)
-        with open(self.tracker_domains_path, 'r') as file:
-            domains = file.read().splitlines()
-            df['is_tracker'] = df['remote_domain'].apply(lambda x: 1 if x in domains else 0)
+        df = read_packages(self.__conn_manual, 'JoinedRequest', self.packages)
+        df = self.trackers.annotate(df)
         return pd.concat([df, self.traffic_auto], axis=0).reset_index(drop=True)
 
+    def __load_traffic_combined(self):
+        # same row order as the concatenation in __load_traffic_manual, both crawls are read concurrently
+        return load_crawls({'manual': self.db_path_manual, 'auto': self.db_path_auto}, self.packages, self.trackers)
+
     def __load_3p(self):
-        query = 'SELECT * FROM JoinedTrackerLibrary WHERE package_name IN (%s)' % self.__apps_string
-        df = pd.read_sql_query(query, self.__conn_auto)
+        df = read_packages(self.__conn_auto, 'JoinedTrackerLibrary', self.packages)
         return df
 
     def __load_perms(self):
-        query = 'SELECT * FROM JoinedPermission WHERE package_name IN (%s)' % self.__apps_string
-        df = pd.read_sql_query(query, self.__conn_auto)
+        df = read_packages(self.__conn_auto, 'JoinedPermission', self.packages)
         return df
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+
+from .find_pii import detect_regexes
+
+# prefixes of the wide per-pattern columns written by apply_regexes and AI_Agent.integrate_*_results
+FLAG_PREFIXES = {'regex': 'detected_', 'ai': 'ai_detected_'}
+TEXT_PREFIXES = {'reasoning': 'ai_reasoning_', 'validation_reasoning': 'ai_validation_reasoning_'}
+# values of the text columns for rows without an entry, as integrate_detection_results initialises them
+TEXT_DEFAULTS = {'reasoning': '', 'validation_reasoning': None}
+
+
+def pack_flags(matrix) -> np.ndarray:
+    # rows x patterns booleans to rows x ceil(patterns / 8) bytes, pattern i is bit i % 8 of byte i // 8
+    return np.packbits(np.asarray(matrix, dtype=bool), axis=1, bitorder='little')
+
+
+def unpack_flags(bits: np.ndarray, n_patterns: int) -> np.ndarray:
+    return np.unpackbits(bits, axis=1, count=n_patterns, bitorder='little').astype(bool)
+
+
+class DetectionStore:
+    # Compact store of per-row, per-pattern detection results. The regex and AI flags are bitmasks with one bit per
+    # pattern (a uint8 array of rows x ceil(patterns / 8)), the AI reasoning strings live in sparse side tables keyed
+    # by pattern index and row position. The legacy wide columns (detected_<name>, ai_detected_<name>,
+    # ai_reasoning_<name>, ai_validation_reasoning_<name>) are only materialized on demand.
+    def __init__(self, names, index):
+        self.names = list(names)
+        self.index = pd.Index(index)
+        self.__positions = {name: i for i, name in enumerate(self.names)}
+        n_bytes = -(-len(self.names) // 8)
+        self.flags = {kind: np.zeros((len(self.index), n_bytes), dtype=np.uint8) for kind in FLAG_PREFIXES}
+        self.texts = {kind: {pattern: {} for pattern in range(len(self.names))} for kind in TEXT_PREFIXES}
+
+    @classmethod
+    def from_regexes(cls, traffic, regexes, workers: int = None, chunksize: int = None):
+        store = cls([pattern['name'] for pattern in regexes], traffic.index)
+        store.flags['regex'] = pack_flags(detect_regexes(traffic, regexes, workers, chunksize).to_numpy())
+        return store
+
+    @classmethod
+    def from_frame(cls, traffic, names):
+        # packs the wide columns of a frame that went through apply_regexes and/or the AI integration
+        store = cls(names, traffic.index)
+        for kind, prefix in FLAG_PREFIXES.items():
+            columns = [f'{prefix}{name}' for name in names]
+            if all(column in traffic.columns for column in columns):
+                # == True, as the plots compare them, so missing values count as not detected
+                store.flags[kind] = pack_flags((traffic[columns] == True).to_numpy())
+        for kind, prefix in TEXT_PREFIXES.items():
+            for pattern, name in enumerate(names):
+                column = f'{prefix}{name}'
+                if column not in traffic.columns:
+                    continue
+                values = traffic[column].to_numpy(dtype=object)
+                filled = pd.notna(values) & (values != TEXT_DEFAULTS[kind])
+                store.texts[kind][pattern] = {int(row): values[row] for row in np.flatnonzero(filled)}
+        return store
+
+    def position(self, name: str) -> int:
+        if name not in self.__positions:
+            raise KeyError(f"Unknown pattern: {name}")
+        return self.__positions[name]
+
+    def flag(self, kind: str, name: str) -> np.ndarray:
+        # bool array of one pattern without unpacking the other patterns
+        pattern = self.position(name)
+        return (self.flags[kind][:, pattern // 8] >> (pattern % 8) & 1).astype(bool)
+
+    def set_flag(self, kind: str, name: str, rows, value: bool):
+        # rows are positions, not index labels
+        pattern = self.position(name)
+        mask = np.uint8(1 << (pattern % 8))
+        if value:
+            self.flags[kind][rows, pattern // 8] |= mask
+        else:
+            self.flags[kind][rows, pattern // 8] &= ~mask
+
+    def text(self, kind: str, name: str) -> pd.Series:
+        values = np.full(len(self.index), TEXT_DEFAULTS[kind], dtype=object)
+        for row, value in self.texts[kind][self.position(name)].items():
+            values[row] = value
+        # a column initialised with '' infers a string dtype, one initialised with None stays object
+        dtype = object if TEXT_DEFAULTS[kind] is None else None
+        return pd.Series(values, index=self.index, name=f'{TEXT_PREFIXES[kind]}{name}', dtype=dtype)
+
+    def set_text(self, kind: str, name: str, row: int, value):
+        entries = self.texts[kind][self.position(name)]
+        if value is None or value == TEXT_DEFAULTS[kind]:
+            entries.pop(row, None)
+        else:
+            entries[row] = value
+
+    def text_table(self, kind: str) -> pd.DataFrame:
+        # the sparse side table as a long frame of (row, pattern, text)
+        entries = [(row, pattern, value) for pattern, rows in self.texts[kind].items() for row, value in rows.items()]
+        entries.sort(key=lambda entry: entry[:2])
+        return pd.DataFrame({
+            'row': self.index[[row for row, _, _ in entries]],
+            'pattern': [self.names[pattern] for _, pattern, _ in entries],
+            'text': [value for _, _, value in entries],
+        })
+
+    def counts(self, kind: str) -> pd.Series:
+        # number of rows flagged per pattern
+        return pd.Series(unpack_flags(self.flags[kind], len(self.names)).sum(axis=0), index=self.names, name=kind)
+
+    def to_frame(self, kinds=('regex', 'ai', 'reasoning', 'validation_reasoning'), names=None) -> pd.DataFrame:
+        # the legacy wide columns, per pattern in the order the AI integration adds them
+        names = self.names if names is None else list(names)
+        flags = {kind: unpack_flags(self.flags[kind], len(self.names)) for kind in FLAG_PREFIXES if kind in kinds}
+        columns = {}
+        if 'regex' in kinds:
+            for name in names:
+                columns[f'detected_{name}'] = flags['regex'][:, self.position(name)]
+        for name in names:
+            if 'ai' in kinds:
+                columns[f'ai_detected_{name}'] = flags['ai'][:, self.position(name)]
+            for kind in TEXT_PREFIXES:
+                if kind in kinds:
+                    columns[f'{TEXT_PREFIXES[kind]}{name}'] = self.text(kind, name)
+        return pd.DataFrame(columns, index=self.index)
+
+    def materialize(self, traffic, kinds=('regex', 'ai', 'reasoning', 'validation_reasoning'), names=None):
+        # traffic with the legacy wide columns joined, for thesis_plot_data and analyse_data
+        wide = self.to_frame(kinds, names)
+        return pd.concat([traffic.drop(columns=wide.columns, errors='ignore'), wide], axis=1)
+
+    def nbytes(self) -> int:
+        return sum(bits.nbytes for bits in self.flags.values())
+
+
+def compact_detections(traffic, names):
+    # splits a wide frame into the frame without the per-pattern columns and a DetectionStore holding them
+    store = DetectionStore.from_frame(traffic, names)
+    prefixes = list(FLAG_PREFIXES.values()) + list(TEXT_PREFIXES.values())
+    columns = [f'{prefix}{name}' for prefix in prefixes for name in names]
+    return traffic.drop(columns=columns, errors='ignore'), store
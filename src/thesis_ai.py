@@ -4,11 +4,19 @@
 import os
 import json
 import time
+import asyncio
+import hashlib
+import numpy as np
 import pandas as pd
 from openai import OpenAI
 from dotenv import load_dotenv
-from typing import List, Dict, Optional
+from typing import Callable, List, Dict, Optional
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from .cache_data import ContentMemo, content_digest
+
+# bump the version of a layout whenever its detection prompt changes, so cached results of the old prompt are not reused
+DETECTION_PROMPT_VERSIONS = {'legacy': 1, 'prefix': 2}
 
 # getter for structured output of the detection #
 def get_detection_schema(patterns):
@@ -60,34 +68,13 @@ def get_validation_schema():
     }
 
 
+##################### prompt assembly #####################
+# Layout 'prefix' puts everything that is the same for all requests (system role, test values, pattern list and
+# instructions) into the system message and only the per-row text into the user message, with the body last. Requests
+# then share a long stable prefix that the provider can cache. Layout 'legacy' reproduces the original prompts.
+PROMPT_LAYOUTS = ('prefix', 'legacy')
 
-
-load_dotenv()  # Environment Variables laden
-class AI_Agent:
-    def __init__(self, model: str, temperature: float, max_tokens: int, data_dir: str = "data_thesis"):
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise ValueError("No OPENAI_API_KEY in the .env found.")
-        self.client = OpenAI(api_key=api_key)
-        
-        # Config-Parameter aus Funktionsargumenten
-        self.model = model
-        self.temperature = temperature
-        self.max_tokens = max_tokens
-        self.data_dir = data_dir
-        
-
-    def create_detection_batch_file(self, traffic: pd.DataFrame, patterns: List[Dict], 
-                                    batch_file_path: str) -> str:
-        pattern_names = [p['name'] for p in patterns]
-        pattern_list = ', '.join(pattern_names)
-        tasks = []
-        for idx, row in traffic.iterrows():
-            if pd.notna(row['request_content']) and str(row['request_content']).strip():
-                request_text = str(row['request_content'])
-                prompt = f"""Analyze this HTTP request body for PII/PHI patterns.
-
-Pattern-specific test values to detect (search semantically):
+PATTERN_TEST_VALUES = """Pattern-specific test values to detect (search semantically):
 
 Device IDs:
 - Device model: Pixel 6A, bluejay
@@ -134,7 +121,18 @@ Medical Info:
 - Heart rate: 70 bpm
 - Blood pressure: 100/75 (systolic/diastolic)
 - Glucose levels: blood sugar data
-- Medical conditions: diabetes, allergies, headache
+- Medical conditions: diabetes, allergies, headache"""
+
+DETECTION_SYSTEM_ROLE = "You are a PII/PHI detection expert analyzing mobile health app traffic. Use semantic understanding, not just exact string matching."
+VALIDATION_SYSTEM_ROLE = "You are a PII validation expert. Verify detections are accurate using semantic understanding."
+
+
+def detection_messages(patterns: List[Dict], request_text: str, layout: str = 'prefix') -> List[Dict]:
+    pattern_list = ', '.join(p['name'] for p in patterns)
+    if layout == 'legacy':
+        prompt = f"""Analyze this HTTP request body for PII/PHI patterns.
+
+{PATTERN_TEST_VALUES}
 
 Request Content: {request_text}
 
@@ -142,42 +140,222 @@ Detect these PII/PHI types: {pattern_list}
 
 For EACH type, return: detected (true/false) and brief reasoning (max 150 chars).
 Search semantically - the exact values may appear in different formats or encodings."""
-                
-                task = {
-                    "custom_id": f"detection-{idx}",
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": {
-                        "model": self.model,
-                        "temperature": self.temperature,
-                        "max_tokens": self.max_tokens,
-                        "response_format": get_detection_schema(patterns),
-                        "messages": [
-                            {
-                                "role": "system",
-                                "content": "You are a PII/PHI detection expert analyzing mobile health app traffic. Use semantic understanding, not just exact string matching."
-                            },
-                            {
-                                "role": "user",
-                                "content": prompt
-                            }
-                        ]
-                    }
-                }
-                tasks.append(task)
+        return [{"role": "system", "content": DETECTION_SYSTEM_ROLE}, {"role": "user", "content": prompt}]
+    system = f"""{DETECTION_SYSTEM_ROLE}
+
+Analyze the HTTP request body in the user message for PII/PHI patterns.
+
+{PATTERN_TEST_VALUES}
+
+Detect these PII/PHI types: {pattern_list}
+
+For EACH type, return: detected (true/false) and brief reasoning (max 150 chars).
+Search semantically - the exact values may appear in different formats or encodings."""
+    return [{"role": "system", "content": system}, {"role": "user", "content": f"Request Content: {request_text}"}]
+
+
+def validation_messages(name: str, initial_reasoning: str, request_text: str, layout: str = 'prefix') -> List[Dict]:
+    if layout == 'legacy':
+        prompt = f"""Validate this PII detection.
+
+{PATTERN_TEST_VALUES}
+
+Pattern: {name}
+Initial Detection: True
+Initial Reasoning: {initial_reasoning}
+
+Request Content: {request_text}
+
+Is this a TRUE POSITIVE or FALSE POSITIVE?
+Verify the detected value matches the pattern semantically.
+Provide reasoning (max 150 chars)."""
+        return [{"role": "system", "content": VALIDATION_SYSTEM_ROLE}, {"role": "user", "content": prompt}]
+    system = f"""{VALIDATION_SYSTEM_ROLE}
+
+Validate the PII detection in the user message.
+
+{PATTERN_TEST_VALUES}
+
+Is the detection a TRUE POSITIVE or FALSE POSITIVE?
+Verify the detected value matches the pattern semantically.
+Provide reasoning (max 150 chars)."""
+    user = f"""Pattern: {name}
+Initial Detection: True
+Initial Reasoning: {initial_reasoning}
+
+Request Content: {request_text}"""
+    return [{"role": "system", "content": system}, {"role": "user", "content": user}]
+
+
+# rough estimate of ~4 characters per token for English text and JSON, good enough to compare prompt layouts
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // 4)
+
+
+def _request_prompt_text(task: Dict) -> str:
+    # the input of a request in the order the provider sees it: response schema, then the messages
+    body = task['body']
+    return json.dumps(body.get('response_format')) + ''.join(m['content'] for m in body['messages'])
+
+
+# estimated input tokens per request, and how many of them are in the prefix all requests share (cacheable)
+def batch_token_report(tasks: List[Dict]) -> pd.DataFrame:
+    texts = [_request_prompt_text(task) for task in tasks]
+    shared_prefix = estimate_tokens(os.path.commonprefix(texts)) if len(texts) > 1 else 0
+    total = np.array([estimate_tokens(text) for text in texts], dtype=np.int64)
+    return pd.DataFrame({
+        'custom_id': [task['custom_id'] for task in tasks],
+        'input_tokens': total,
+        'shared_prefix_tokens': np.minimum(total, shared_prefix),
+        'unique_tokens': total - np.minimum(total, shared_prefix),
+    })
+
+
+##################### batch sharding #####################
+# limits of a single job of the Batch API; the enqueued-token limit depends on the model and usage tier, so it is
+# not enforced unless max_tokens is given
+BATCH_MAX_REQUESTS = 50_000
+BATCH_MAX_BYTES = 200 * 1024 ** 2
+
+
+# Splits the lines of a batch file into consecutive shards that each stay within the request, byte and (estimated)
+# token limits. Returns one (lines, bytes, tokens) tuple per shard, tokens is None if max_tokens is not given.
+def shard_batch_lines(lines: List[str], max_requests: int = BATCH_MAX_REQUESTS, max_bytes: int = BATCH_MAX_BYTES,
+                      max_tokens: Optional[int] = None) -> List[tuple]:
+    shards = []
+    current, current_bytes, current_tokens = [], 0, 0
+    for line in lines:
+        size = len(line.encode('utf-8'))
+        tokens = estimate_tokens(_request_prompt_text(json.loads(line))) if max_tokens is not None else 0
+        if size > max_bytes or (max_tokens is not None and tokens > max_tokens):
+            raise ValueError(f"A single request exceeds the batch limits ({size} bytes, {tokens} tokens)")
+        if current and (len(current) >= max_requests or current_bytes + size > max_bytes
+                        or (max_tokens is not None and current_tokens + tokens > max_tokens)):
+            shards.append((current, current_bytes, current_tokens if max_tokens is not None else None))
+            current, current_bytes, current_tokens = [], 0, 0
+        current.append(line)
+        current_bytes += size
+        current_tokens += tokens
+    if current:
+        shards.append((current, current_bytes, current_tokens if max_tokens is not None else None))
+    return shards
+
+
+def load_manifest(manifest_path: str) -> Dict:
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+# namespace of the cached detection results, a result is only reused for the same model, temperature, prompt and patterns
+def detection_cache_namespace(model: str, temperature: float, patterns: List[Dict],
+                              prompt_version: int = DETECTION_PROMPT_VERSIONS['prefix']) -> str:
+    payload = json.dumps({'model': model, 'temperature': temperature, 'prompt_version': prompt_version,
+                          'patterns': [p['name'] for p in patterns]})
+    return 'ai_detection:' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# rows with a non-empty body, the same rows the detection batch is created for
+def _detection_rows(traffic: pd.DataFrame) -> pd.Series:
+    content = traffic['request_content']
+    return content.notna() & (content.astype(str).str.strip() != '')
+
+
+load_dotenv()  # Environment Variables laden
+class AI_Agent:
+    def __init__(self, model: str, temperature: float, max_tokens: int, data_dir: str = "data_thesis",
+                 cache: Optional[ContentMemo] = None, prompt_layout: str = 'prefix'):
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise ValueError("No OPENAI_API_KEY in the .env found.")
+        self.client = OpenAI(api_key=api_key)
+        
+        # Config-Parameter aus Funktionsargumenten
+        self.model = model
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.data_dir = data_dir
+        # optional ContentMemo (with a path to persist it) of detection results per body, see create_detection_batch_file
+        self.cache = cache
+        # see PROMPT_LAYOUTS, 'legacy' reproduces the prompts of earlier runs
+        if prompt_layout not in PROMPT_LAYOUTS:
+            raise ValueError(f"Unknown prompt layout: {prompt_layout}")
+        self.prompt_layout = prompt_layout
         
-        print("Creating detection batch file...")
+
+    def create_detection_batch_file(self, traffic: pd.DataFrame, patterns: List[Dict], 
+                                    batch_file_path: str) -> Optional[str]:
+        # With a cache every distinct body is requested once, and bodies with a cached result are not requested at all.
+        # The custom_id names the first row with the body, integrate_detection_results fans the result out again.
+        if self.cache is not None:
+            return self.__create_cached_detection_batch_file(traffic, patterns, batch_file_path)
+        tasks = []
+        for idx, row in traffic.iterrows():
+            if pd.notna(row['request_content']) and str(row['request_content']).strip():
+                tasks.append(self.__detection_task(idx, str(row['request_content']), patterns))
+        return self.__write_batch_file(tasks, batch_file_path)
+
+    def __create_cached_detection_batch_file(self, traffic: pd.DataFrame, patterns: List[Dict],
+                                             batch_file_path: str) -> Optional[str]:
+        bodies = traffic.loc[_detection_rows(traffic), 'request_content'].astype(str)
+        first_rows = bodies.drop_duplicates()
+        digests = [content_digest(body) for body in first_rows]
+        cached = self.cache.lookup(detection_cache_namespace(self.model, self.temperature, patterns,
+                                                   DETECTION_PROMPT_VERSIONS[self.prompt_layout]), digests)
+        tasks = [self.__detection_task(idx, body, patterns)
+                 for (idx, body), digest in zip(first_rows.items(), digests) if digest not in cached]
+        print(f"{len(bodies)} rows with a body, {len(first_rows)} distinct bodies, {len(cached)} cached")
+        return self.__write_batch_file(tasks, batch_file_path)
+
+    def __write_batch_file(self, tasks: List[Dict], batch_file_path: str, kind: str = 'detection') -> Optional[str]:
+        # returns None instead of writing an empty batch file (e.g. when every body has a cached result), a batch
+        # file left at the path by an earlier run is removed so it cannot be uploaded by mistake
+        if not tasks:
+            if os.path.exists(batch_file_path):
+                os.remove(batch_file_path)
+            print(f"No {kind} requests to send, no batch file created")
+            return None
+        print(f"Creating {kind} batch file...")
         os.makedirs(os.path.dirname(batch_file_path) or '.', exist_ok=True)
         with open(batch_file_path, 'w', encoding='utf-8') as f:
             for task in tasks:
                 f.write(json.dumps(task) + '\n')
-        print(f"Created {batch_file_path} with {len(tasks)} detection requests")
+        print(f"Created {batch_file_path} with {len(tasks)} {kind} requests")
+        self.__print_token_estimate(batch_token_report(tasks))
         return batch_file_path
+
+    def __print_token_estimate(self, report: pd.DataFrame):
+        if report.empty:
+            return
+        total = int(report['input_tokens'].sum())
+        shared = int(report['shared_prefix_tokens'].iloc[0])
+        print(f"Estimated input tokens: {total} ({total // len(report)} per request, "
+              f"{shared} of them in the prefix shared by all requests)")
+
+    def estimate_batch_tokens(self, batch_file_path: str) -> pd.DataFrame:
+        # token estimate per request of an existing batch file, e.g. to compare prompt layouts before uploading
+        with open(batch_file_path, 'r', encoding='utf-8') as f:
+            report = batch_token_report([json.loads(line) for line in f])
+        self.__print_token_estimate(report)
+        return report
+
+    def __detection_task(self, idx, request_text: str, patterns: List[Dict]) -> Dict:
+        return {
+            "custom_id": f"detection-{idx}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": self.model,
+                "temperature": self.temperature,
+                "max_tokens": self.max_tokens,
+                "response_format": get_detection_schema(patterns),
+                "messages": detection_messages(patterns, request_text, self.prompt_layout)
+            }
+        }
     
 
 ###################for debugging of this method, cursor was used to generate parts of the following method##############################################
     def create_validation_batch_file(self, traffic_with_detection: pd.DataFrame, patterns: List[Dict],
-                                    batch_file_path: str) -> str:
+                                    batch_file_path: str) -> Optional[str]:
         tasks = []
         for idx, row in traffic_with_detection.iterrows():
             if pd.notna(row['request_content']) and str(row['request_content']).strip():
@@ -188,67 +366,6 @@ Search semantically - the exact values may appear in different formats or encodi
                         initial_reasoning = row.get(f'ai_reasoning_{name}', '')
 ###################until this part for debugging of this method, cursor was used to generate parts of the ##############################################
                         
-                        prompt = f"""Validate this PII detection.
-
-Pattern-specific test values to detect (search semantically):
-
-Device IDs:
-- Device model: Pixel 6A, bluejay
-- Resolution: 1080
-- Carrier name: nettokom
-- OS build: TP1A.220624.021.A1
-- API level: 33
-
-Location:
-- City: Berlin
-- Latitude: 52.5, 52.6
-- Longitude: 13.3, 13.4
-
-User Info:
-- Name: Freya
-- Email address: mhealthcrawl2024@gmail.com
-- Advertising ID: 30f17059
-- Age: 34
-- Date of birth: 1990
-- Gender: female
-
-Body Measurements & Fitness:
-- Body height: 170 cm
-- Body weight: 65 kg
-- Body weight goal: 60 kg
-- BMI: 22
-- Step count: 271 steps, step goals
-- Eating habits: vegetarian, diet
-- Fitness goals: lose weight, weight loss
-- Fitness level: medium, beginner
-- Mental wellbeing: stress, lack of sleep, forgetful
-- Sleep habits: sleep between 5-6 hours, sleep quality
-
-Female Health:
-- Cycle length: 29 days
-- Period start date: menstruation start dates
-- Period length: 5 days
-- Period symptoms: acne, dysmenorrhea, discharge, cravings, mucus
-- Birth control: birth control pills, contraception
-
-Medical Info:
-- Sexual activity: sexual activity data, condom use
-- Body temperature: 37°C
-- Heart rate: 70 bpm
-- Blood pressure: 100/75 (systolic/diastolic)
-- Glucose levels: blood sugar data
-- Medical conditions: diabetes, allergies, headache
-
-Pattern: {name}
-Initial Detection: True
-Initial Reasoning: {initial_reasoning}
-
-Request Content: {request_text}
-
-Is this a TRUE POSITIVE or FALSE POSITIVE?
-Verify the detected value matches the pattern semantically.
-Provide reasoning (max 150 chars)."""
-                        
                         task = {
                             "custom_id": f"validation-{idx}-{name}",
                             "method": "POST",
@@ -258,34 +375,22 @@ Provide reasoning (max 150 chars)."""
                                 "temperature": self.temperature,
                                 "max_tokens": 1000,
                                 "response_format": get_validation_schema(),
-                                "messages": [
-                                    {
-                                        "role": "system",
-                                        "content": "You are a PII validation expert. Verify detections are accurate using semantic understanding."
-                                    },
-                                    {
-                                        "role": "user",
-                                        "content": prompt
-                                    }
-                                ]
+                                "messages": validation_messages(name, initial_reasoning, request_text,
+                                                                self.prompt_layout)
                             }
                         }
                         tasks.append(task)
         
-        print("Creating validation batch file...")
-        os.makedirs(os.path.dirname(batch_file_path) or '.', exist_ok=True)
-        with open(batch_file_path, 'w', encoding='utf-8') as f:
-            for task in tasks:
-                f.write(json.dumps(task) + '\n')
-        
-        print(f"Created {batch_file_path} with {len(tasks)} validation requests")
-        return batch_file_path
+        return self.__write_batch_file(tasks, batch_file_path, 'validation')
     
     def upload_batch_file(self, batch_file_path: str) -> str:
-        batch_file = self.client.files.create(
-            file=open(batch_file_path, "rb"),
-            purpose="batch"
-        )
+        if batch_file_path is None or os.path.getsize(batch_file_path) == 0:
+            raise ValueError(f"Empty batch file, nothing to upload: {batch_file_path}")
+        with open(batch_file_path, "rb") as file:
+            batch_file = self.client.files.create(
+                file=file,
+                purpose="batch"
+            )
         print(f"File uploaded: {batch_file.id}")
         batch_job = self.client.batches.create(
             input_file_id=batch_file.id,
@@ -295,6 +400,56 @@ Provide reasoning (max 150 chars)."""
         print(f"Batch job started: {batch_job.id}")
         return batch_job.id
     
+    def write_batch_shards(self, batch_file_path: str, max_requests: int = BATCH_MAX_REQUESTS,
+                           max_bytes: int = BATCH_MAX_BYTES, max_tokens: Optional[int] = None) -> List[Dict]:
+        # splits a batch file into <name>_part000.jsonl, <name>_part001.jsonl, ... next to it
+        if batch_file_path is None:
+            raise ValueError("No batch file to shard, the batch had no requests")
+        with open(batch_file_path, 'r', encoding='utf-8') as f:
+            lines = [line if line.endswith('\n') else line + '\n' for line in f if line.strip()]
+        stem, ext = os.path.splitext(batch_file_path)
+        shards = []
+        for i, (shard_lines, size, tokens) in enumerate(shard_batch_lines(lines, max_requests, max_bytes, max_tokens)):
+            path = f"{stem}_part{i:03d}{ext or '.jsonl'}"
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(shard_lines)
+            shards.append({'path': path, 'requests': len(shard_lines), 'bytes': size, 'tokens': tokens})
+        print(f"Split {batch_file_path} into {len(shards)} shards")
+        return shards
+
+    def upload_batch_shards(self, batch_file_path: str, manifest_path: Optional[str] = None, max_workers: int = 4,
+                            max_requests: int = BATCH_MAX_REQUESTS, max_bytes: int = BATCH_MAX_BYTES,
+                            max_tokens: Optional[int] = None) -> Dict:
+        # One logical run as many batch jobs: shards the batch file, uploads the shards concurrently and writes a
+        # manifest (<name>_manifest.json by default) with the batch job id of every shard. A shard whose upload failed
+        # has an error instead of a batch_id and can be uploaded again with upload_batch_file.
+        shards = self.write_batch_shards(batch_file_path, max_requests, max_bytes, max_tokens)
+
+        def upload(shard):
+            try:
+                shard['batch_id'] = self.upload_batch_file(shard['path'])
+            except Exception as e:
+                print(f"Error uploading {shard['path']}: {e}")
+                shard['batch_id'] = None
+                shard['error'] = str(e)
+            return shard
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            shards = list(executor.map(upload, shards))
+        manifest = {
+            'source': batch_file_path,
+            'created': datetime.now().isoformat(),
+            'model': self.model,
+            'shards': shards,
+        }
+        if manifest_path is None:
+            manifest_path = os.path.splitext(batch_file_path)[0] + '_manifest.json'
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, indent=2)
+        failed = sum(1 for shard in shards if shard['batch_id'] is None)
+        print(f"Manifest saved: {manifest_path} ({len(shards) - failed} jobs started, {failed} failed)")
+        return manifest
+
     def check_batch_status(self, batch_job_id: str) -> Dict:
         batch_job = self.client.batches.retrieve(batch_job_id)
         return {
@@ -335,8 +490,13 @@ Provide reasoning (max 150 chars)."""
 
  ###################for debugging of the integration functionality, cursor was used to generate parts of the following method##############################################
 
-    def integrate_detection_results(self, results_file_path: str, traffic: pd.DataFrame, 
-                                    patterns: List[Dict]) -> pd.DataFrame:
+    def integrate_detection_results(self, results_file_path: Optional[str], traffic: pd.DataFrame, 
+                                    patterns: List[Dict], reset: bool = True) -> pd.DataFrame:
+        # with a cache the fresh results are stored per body, then the cached results of all bodies are applied to
+        # every row sharing that body; results_file_path may be None if the batch had no cache misses.
+        # With reset=False existing ai_ columns are kept, so the results of several shards can be integrated one by one.
+        if self.cache is not None:
+            return self.__integrate_cached_detection_results(results_file_path, traffic, patterns)
         if not os.path.exists(results_file_path):
             raise FileNotFoundError(f"Results file not found: {results_file_path}")
         results = []
@@ -350,6 +510,8 @@ Provide reasoning (max 150 chars)."""
         traffic_copy = traffic.copy()
         for pattern in patterns:
             name = pattern['name']
+            if not reset and f'ai_detected_{name}' in traffic_copy.columns:
+                continue
             traffic_copy[f'ai_detected_{name}'] = False
             traffic_copy[f'ai_reasoning_{name}'] = ''
             traffic_copy[f'ai_validation_reasoning_{name}'] = None
@@ -377,6 +539,62 @@ Provide reasoning (max 150 chars)."""
         print(f"Integration complete: {success_count} successful, {error_count} errors")
         return traffic_copy
 
+    def __integrate_cached_detection_results(self, results_file_path: Optional[str], traffic: pd.DataFrame,
+                                             patterns: List[Dict]) -> pd.DataFrame:
+        namespace = detection_cache_namespace(self.model, self.temperature, patterns,
+                                                   DETECTION_PROMPT_VERSIONS[self.prompt_layout])
+        fresh = {}
+        error_count = 0
+        if results_file_path is not None:
+            if not os.path.exists(results_file_path):
+                raise FileNotFoundError(f"Results file not found: {results_file_path}")
+            with open(results_file_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    result = json.loads(line)
+                    idx = int(result['custom_id'].split('-')[1])
+                    if result['response']['status_code'] != 200:
+                        error_count += 1
+                        continue
+                    try:
+                        content = result['response']['body']['choices'][0]['message']['content']
+                        detections = json.loads(content).get('detections', [])
+                        fresh[content_digest(str(traffic.at[idx, 'request_content']))] = detections
+                    except Exception as e:
+                        print(f"Error parsing result for row {idx}: {e}")
+                        error_count += 1
+        if fresh:
+            self.cache.store(namespace, fresh)
+
+        rows = np.flatnonzero(_detection_rows(traffic).to_numpy())
+        codes, bodies = pd.factorize(traffic['request_content'].iloc[rows].astype(str))
+        digests = [content_digest(body) for body in bodies]
+        cached = self.cache.lookup(namespace, digests)
+        names = [p['name'] for p in patterns]
+        detected = {name: np.zeros(len(traffic), dtype=bool) for name in names}
+        reasoning = {name: np.full(len(traffic), '', dtype=object) for name in names}
+        # rows grouped by body: the rows of body code are rows[order[bounds[code]:bounds[code + 1]]]
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(digests) + 1))
+        filled = 0
+        for code, digest in enumerate(digests):
+            if digest not in cached:
+                continue
+            targets = rows[order[bounds[code]:bounds[code + 1]]]
+            filled += len(targets)
+            for item in cached[digest]:
+                if item['pattern'] in detected:
+                    detected[item['pattern']][targets] = item['detected']
+                    reasoning[item['pattern']][targets] = item['reasoning']
+
+        traffic_copy = traffic.copy()
+        for name in names:
+            traffic_copy[f'ai_detected_{name}'] = detected[name]
+            traffic_copy[f'ai_reasoning_{name}'] = pd.Series(reasoning[name], index=traffic.index).astype(str)
+            traffic_copy[f'ai_validation_reasoning_{name}'] = None
+        print(f"Integration complete: {len(fresh)} fresh results, {error_count} errors, "
+              f"{filled} of {len(rows)} rows filled from {len(cached)} cached bodies")
+        return traffic_copy
+
     def integrate_validation_results(self, results_file_path: str, traffic_with_detection: pd.DataFrame) -> pd.DataFrame:
         if not os.path.exists(results_file_path):
             raise FileNotFoundError(f"Results file not found: {results_file_path}")
@@ -407,4 +625,132 @@ Provide reasoning (max 150 chars)."""
         return traffic_copy
 
 
-
+##################### asynchronous batch job orchestration #####################
+class BatchJobManager:
+    # Tracks many batch jobs of an AI_Agent at once. Every job is polled with exponential backoff (poll_interval,
+    # multiplied by backoff after each poll up to max_poll_interval), and its output file is streamed to output_dir as
+    # soon as the job completes. With traffic (and patterns for detection) the results are integrated into
+    # self.traffic job by job as they arrive; on_result is called with the job record after each download.
+    # Only the agent's client is used, so a local stub of the batches and files endpoints can stand in for the API.
+    TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+
+    def __init__(self, agent: AI_Agent, output_dir: Optional[str] = None, poll_interval: float = 10.0,
+                 max_poll_interval: float = 600.0, backoff: float = 2.0, max_errors: int = 5,
+                 traffic: Optional[pd.DataFrame] = None, patterns: Optional[List[Dict]] = None,
+                 kind: str = 'detection', on_result: Optional[Callable[[Dict], None]] = None):
+        if kind not in ('detection', 'validation'):
+            raise ValueError(f"Unknown result kind: {kind}")
+        if traffic is not None and kind == 'detection' and patterns is None:
+            raise ValueError("Integrating detection results needs the patterns.")
+        self.agent = agent
+        self.output_dir = output_dir if output_dir is not None else agent.data_dir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.max_errors = max_errors
+        self.traffic = traffic
+        self.patterns = patterns
+        self.kind = kind
+        self.on_result = on_result
+        self.jobs = {}
+        self.__integrated = 0
+
+    def add(self, batch_id: str, output_file: Optional[str] = None):
+        if output_file is None:
+            output_file = os.path.join(self.output_dir, f"{batch_id}_output.jsonl")
+        self.jobs[batch_id] = {'batch_id': batch_id, 'status': None, 'request_counts': None, 'polls': 0,
+                               'output_file': output_file, 'downloaded': False, 'error': None}
+
+    def add_manifest(self, manifest: Dict):
+        # the jobs of a manifest written by AI_Agent.upload_batch_shards, shards without a batch job are skipped
+        for shard in manifest['shards']:
+            if shard.get('batch_id'):
+                self.add(shard['batch_id'])
+
+    async def run(self) -> Dict[str, Dict]:
+        # polls all jobs that are not finished yet until they are, returns the job records by batch id
+        pending = [job for job in self.jobs.values() if not job['downloaded'] and job['error'] is None]
+        await asyncio.gather(*(self.__watch(job) for job in pending))
+        done = sum(1 for job in self.jobs.values() if job['downloaded'])
+        print(f"All batch jobs finished: {done} of {len(self.jobs)} downloaded")
+        return self.jobs
+
+    def run_sync(self) -> Dict[str, Dict]:
+        # for scripts; in a notebook, where an event loop is already running, use 'await manager.run()' instead
+        return asyncio.run(self.run())
+
+    async def __watch(self, job: Dict):
+        delay = self.poll_interval
+        errors = 0
+        missing_output = 0
+        while True:
+            try:
+                status = await asyncio.to_thread(self.agent.check_batch_status, job['batch_id'])
+                errors = 0
+            except Exception as e:
+                errors += 1
+                if errors >= self.max_errors:
+                    job['error'] = f"Polling failed {errors} times: {e}"
+                    print(f"Batch {job['batch_id']}: {job['error']}")
+                    return
+                status = None
+            if status is not None:
+                if status['status'] != job['status']:
+                    counts = status['request_counts']
+                    print(f"Batch {job['batch_id']}: {status['status']} ({counts['completed']}/{counts['total']})")
+                job['status'] = status['status']
+                job['request_counts'] = status['request_counts']
+                job['polls'] += 1
+                if status['status'] == 'completed' and status['output_file_id'] is not None:
+                    await self.__finish(job, status['output_file_id'])
+                    return
+                # a completed job may report its output file only a little later, or never if every request failed
+                if status['status'] == 'completed':
+                    missing_output += 1
+                    if missing_output >= self.max_errors:
+                        job['error'] = "Output file ID not available after job completion."
+                        print(f"Batch {job['batch_id']}: {job['error']}")
+                        return
+                if status['status'] in self.TERMINAL_STATUSES and status['status'] != 'completed':
+                    job['error'] = f"Batch job {status['status']}"
+                    return
+            await asyncio.sleep(delay)
+            delay = min(delay * self.backoff, self.max_poll_interval)
+
+    async def __finish(self, job: Dict, output_file_id: str):
+        try:
+            await asyncio.to_thread(self.__download, output_file_id, job['output_file'])
+        except Exception as e:
+            job['error'] = f"Download failed: {e}"
+            print(f"Batch {job['batch_id']}: {job['error']}")
+            return
+        job['downloaded'] = True
+        print(f"Results saved: {job['output_file']}")
+        # integration runs on the event loop, so the jobs never integrate into self.traffic at the same time
+        try:
+            if self.traffic is not None:
+                self.__integrate(job['output_file'])
+            if self.on_result is not None:
+                self.on_result(job)
+        except Exception as e:
+            job['error'] = f"Integration failed: {e}"
+            print(f"Batch {job['batch_id']}: {job['error']}")
+
+    def __download(self, output_file_id: str, output_file: str):
+        # streamed to a temporary file first, so a partial download never looks like a result file
+        os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        tmp_file = output_file + '.part'
+        with self.agent.client.files.with_streaming_response.content(output_file_id) as response:
+            with open(tmp_file, 'wb') as f:
+                for chunk in response.iter_bytes():
+                    f.write(chunk)
+        os.replace(tmp_file, output_file)
+
+    def __integrate(self, output_file: str):
+        if self.kind == 'validation':
+            self.traffic = self.agent.integrate_validation_results(output_file, self.traffic)
+        else:
+            # the first result file initialises the ai_ columns, the later ones only fill in their rows
+            self.traffic = self.agent.integrate_detection_results(output_file, self.traffic, self.patterns,
+                                                                  reset=self.__integrated == 0)
+        self.__integrated += 1